@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+# A stand-in for the Ollama server, for benchmarking and testing the Guide's
+# streaming and UI path without running a model. It speaks the parts of the
+# API main.py uses (/api/chat and /api/generate, streamed as JSON lines, and
+# an empty /api/generate to load the model) at a chosen token rate, after a
+# chosen delay before the first token, and can fail some requests on purpose.
+#
+#   python3 bench/fake_ollama.py --port 11435 --tokens-per-second 8 --first-token-ms 1500
+#   OLLAMA_HOST=127.0.0.1:11435 python3 main.py
+#   OLLAMA_HOST=127.0.0.1:11435 python3 main.py --bench guide_typing --bench-llm http
+import argparse
+import json
+import random
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# --- COMMAND LINE OPTIONS ---
+arg_parser = argparse.ArgumentParser(description="Fake Ollama server for load tests")
+arg_parser.add_argument("--host", default="127.0.0.1")
+arg_parser.add_argument("--port", type=int, default=11435)
+arg_parser.add_argument("--tokens-per-second", type=float, default=10.0,
+                        help="generation speed once the first token is out (default: %(default)s)")
+arg_parser.add_argument("--first-token-ms", type=float, default=800.0,
+                        help="delay before the first token, like prompt evaluation (default: %(default)s)")
+arg_parser.add_argument("--load-ms", type=float, default=0.0,
+                        help="extra delay the first time the model is used, like loading it (default: %(default)s)")
+arg_parser.add_argument("--jitter", type=float, default=0.2,
+                        help="random variation of each delay, as a fraction of it (default: %(default)s)")
+arg_parser.add_argument("--max-tokens", type=int, default=0,
+                        help="cut every answer to this many tokens (default: the whole canned answer)")
+arg_parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="fraction of requests answered with HTTP 500 (default: %(default)s)")
+arg_parser.add_argument("--stream-error-rate", type=float, default=0.0,
+                        help="fraction of requests that send an error line halfway through (default: %(default)s)")
+arg_parser.add_argument("--drop-rate", type=float, default=0.0,
+                        help="fraction of requests whose connection is closed halfway through (default: %(default)s)")
+arg_parser.add_argument("--seed", type=int, help="make the jitter and the injected errors repeatable")
+args = arg_parser.parse_args()
+
+# Rambling on purpose: the real model rarely stops after one or two sentences.
+ANSWERS = [
+    "The answer is forty-two. Nobody is quite sure what the question was, which has caused a great deal "
+    "of trouble for philosophers. The Guide suggests you do not dwell on it. Instead, have a cup of tea. "
+    "Tea is, after all, the one thing the Nutri-Matic machine has never managed to get right.",
+    "A towel is the most massively useful thing an interstellar hitchhiker can carry. You can wrap it "
+    "around you for warmth. You can lie on it on the jewelled beaches of Santraginus V. You can wave it "
+    "in emergencies as a distress signal. Most importantly, a hitchhiker with a towel is assumed to be "
+    "a person of great resourcefulness.",
+    "Zaphod Beeblebrox was President of the Galaxy for two years. He has two heads and three arms, and "
+    "most of his decisions are made by whichever head is paying attention. He stole the Heart of Gold "
+    "at its launch. Nobody was surprised, least of all Zaphod.",
+    "Space is big. Really big. You just won't believe how vastly, hugely, mind-bogglingly big it is. "
+    "You may think it's a long way down the road to the chemist's, but that's just peanuts to space. "
+    "The Guide apologises for the inconvenience.",
+]
+TOKEN_PATTERN = re.compile(r"\s*[^\s.,!?;:]+|\s*[.,!?;:]")
+MODEL_LOAD_LOCK = threading.Lock()
+model_loaded = False
+rng = random.Random(args.seed)
+rng_lock = threading.Lock()
+stats = {"requests": 0, "completed": 0, "errors": 0, "drops": 0, "cancelled": 0}
+stats_lock = threading.Lock()
+
+def chance(rate):
+    with rng_lock:
+        return rng.random() < rate
+
+def jittered(seconds):
+    with rng_lock:
+        return max(0.0, seconds * (1.0 + rng.uniform(-args.jitter, args.jitter)))
+
+def count(key):
+    with stats_lock:
+        stats[key] += 1
+
+def answer_tokens(question):
+    # The same question always gets the same answer.
+    text = ANSWERS[sum(map(ord, question)) % len(ANSWERS)]
+    tokens = TOKEN_PATTERN.findall(text)
+    return tokens[:args.max_tokens] if args.max_tokens else tokens
+
+def load_model():
+    global model_loaded
+    with MODEL_LOAD_LOCK:
+        if not model_loaded:
+            time.sleep(args.load_ms / 1000.0)
+            model_loaded = True
+
+class OllamaHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"   # Keep-alive, like the real server
+
+    def log_message(self, format, *log_args):
+        pass
+
+    def send_json(self, status, payload):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_chunk(self, payload):
+        data = (json.dumps(payload) + "\n").encode("utf-8")
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path == "/api/tags":
+            self.send_json(200, {"models": [{"name": "tinyllama:latest"}]})
+        else:
+            self.send_json(200, {"status": "Ollama is running"})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            self.send_json(400, {"error": "invalid JSON"})
+            return
+        if self.path not in ("/api/chat", "/api/generate"):
+            self.send_json(404, {"error": "not found"})
+            return
+        chat = self.path == "/api/chat"
+        if chat:
+            messages = body.get("messages") or []
+            question = messages[-1]["content"] if messages else ""
+        else:
+            question = body.get("prompt", "")
+        started = time.perf_counter()
+        load_model()
+        if not question:
+            # An empty request only loads the model.
+            self.send_json(200, {"model": body.get("model"), "done": True, "done_reason": "load"})
+            return
+        count("requests")
+        if chance(args.error_rate):
+            count("errors")
+            self.send_json(500, {"error": "injected failure"})
+            return
+        tokens = answer_tokens(question)
+        # Like Ollama, stop at options.num_predict tokens with done_reason "length".
+        limit = (body.get("options") or {}).get("num_predict") or 0
+        done_reason = "length" if 0 < limit < len(tokens) else "stop"
+        if done_reason == "length":
+            tokens = tokens[:limit]
+        fail_at = len(tokens) // 2 if chance(args.stream_error_rate) else None
+        drop_at = len(tokens) // 2 if fail_at is None and chance(args.drop_rate) else None
+        if body.get("stream", True) is False:
+            time.sleep(jittered(args.first_token_ms / 1000.0) + len(tokens) / args.tokens_per_second)
+            reply = "".join(tokens)
+            payload = {"message": {"role": "assistant", "content": reply}} if chat else {"response": reply}
+            payload.update(done=True, eval_count=len(tokens))
+            self.send_json(200, payload)
+            count("completed")
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        prompt_done = time.perf_counter()
+        sent = 0
+        try:
+            time.sleep(jittered(args.first_token_ms / 1000.0))
+            prompt_done = time.perf_counter()
+            for i, token in enumerate(tokens):
+                if i:
+                    time.sleep(jittered(1.0 / args.tokens_per_second))
+                if i == fail_at:
+                    count("errors")
+                    self.send_chunk({"error": "injected failure after %d tokens" % i})
+                    self.wfile.write(b"0\r\n\r\n")
+                    return
+                if i == drop_at:
+                    count("drops")
+                    self.close_connection = True
+                    return
+                self.send_chunk({"message": {"role": "assistant", "content": token}, "done": False} if chat
+                                else {"response": token, "done": False})
+                sent += 1
+            now = time.perf_counter()
+            done = {"done": True, "done_reason": done_reason,
+                    "total_duration": int((now - started) * 1e9),
+                    "prompt_eval_count": len(question.split()),
+                    "prompt_eval_duration": int((prompt_done - started) * 1e9),
+                    "eval_count": sent,
+                    "eval_duration": int((now - prompt_done) * 1e9)}
+            done.update({"message": {"role": "assistant", "content": ""}} if chat else {"response": ""})
+            self.send_chunk(done)
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+            count("completed")
+        except OSError:
+            # The app closes the connection to stop a generation.
+            count("cancelled")
+            self.close_connection = True
+            sys.stderr.write("cancelled after %d tokens\n" % sent)
+
+def report():
+    # A line every 10 seconds while requests are coming in.
+    last = None
+    while True:
+        time.sleep(10)
+        with stats_lock:
+            line = ", ".join("%s %d" % item for item in stats.items())
+        if line != last:
+            sys.stderr.write(line + "\n")
+            last = line
+
+server = ThreadingHTTPServer((args.host, args.port), OllamaHandler)
+server.daemon_threads = True
+threading.Thread(target=report, daemon=True).start()
+print("Fake Ollama on http://%s:%d: %.1f tokens/s, first token after %.0f ms" % (
+    args.host, args.port, args.tokens_per_second, args.first_token_ms), flush=True)
+try:
+    server.serve_forever()
+except KeyboardInterrupt:
+    pass
@@ -21,6 +21,10 @@ else
   echo "✅ Ollama already installed."
 fi
 
+# Pack the Guide pages into one file the app can map at startup
+echo "📚 Packing Guide pages..."
+python3 main.py --build-pack
+
 # Pull the TinyLlama model (will prompt if not running Ollama yet)
 echo "📦 Pulling TinyLlama model (this may take a few minutes)..."
 ollama pull tinyllama
@@ -4,6 +4,318 @@ import os
 import subprocess  # For calling Ollama
 import threading   # For asynchronous LLM call
 import gc          # Optional garbage collection
+import tracemalloc # Allocation sites for the memory report
+import json        # Ollama HTTP API payloads
+import codecs      # Incremental UTF-8 decoding of CLI output
+import http.client # Keep-alive connections to the Ollama server
+import socket      # Shutting down a connection to cancel a generation
+import hashlib     # Keys for the LLM response cache and the asset cache
+import io          # Fonts opened from bytes read once
+import re
+import time
+import argparse
+import mmap        # Content pack is mapped instead of read
+import struct
+import bisect      # Prefix lookups in the search index
+import math
+import tempfile
+import concurrent.futures  # Worker pool for --pregenerate
+from urllib.parse import urlsplit
+from collections import OrderedDict  # LRU order for the text cache
+from collections import deque        # Ring buffer for the frame profiler
+
+process_start = time.perf_counter()  # Reference point for time-to-interactive
+
+# --- COMMAND LINE OPTIONS ---
+arg_parser = argparse.ArgumentParser(description="Interactive Hitchhiker's Guide")
+arg_parser.add_argument("--no-llm-cache", action="store_true",
+                        help="always ask the model, ignoring cached and canned answers")
+arg_parser.add_argument("--clear-llm-cache", action="store_true",
+                        help="delete all cached answers before starting")
+arg_parser.add_argument("--build-pack", action="store_true",
+                        help="pack assets/pages into assets/pages.pack and exit")
+arg_parser.add_argument("--bench", nargs="*", metavar="SCENARIO",
+                        help="replay benchmark scenarios headlessly (all of them if none are named) and exit")
+arg_parser.add_argument("--bench-save-baseline", action="store_true",
+                        help="with --bench, store the results as the new baseline")
+arg_parser.add_argument("--bench-llm", choices=["stub", "http"], default="stub",
+                        help="with --bench, answer Guide questions from the built-in stub or from the server at "
+                             "OLLAMA_HOST, e.g. bench/fake_ollama.py (default: %(default)s)")
+arg_parser.add_argument("--bench-wrap", nargs="*", metavar="FILE",
+                        help="time wrap_text on text files (every page if none are given) and exit")
+arg_parser.add_argument("--pregenerate", metavar="QUESTIONS",
+                        help="ask the model every question in QUESTIONS (one per line) that has no canned "
+                             "answer yet, add the answers to assets/answers.json and exit")
+arg_parser.add_argument("--pregenerate-workers", type=int, default=2, metavar="N",
+                        help="questions --pregenerate asks at once (match OLLAMA_NUM_PARALLEL; default: %(default)s)")
+arg_parser.add_argument("--check-canned", nargs="?", const=os.path.join("bench", "canned_probes.json"), metavar="PROBES",
+                        help="check which canned answer each probe question gets and exit (default: %(const)s)")
+arg_parser.add_argument("--bench-scenario", help=argparse.SUPPRESS)
+arg_parser.add_argument("--bench-out", help=argparse.SUPPRESS)
+arg_parser.add_argument("--record-events", metavar="PATH",
+                        help="record taps, scrolls and typing to a benchmark scenario file")
+arg_parser.add_argument("--hud", action="store_true",
+                        help="start with the frame profiler overlay shown (F3 toggles it)")
+arg_parser.add_argument("--profile-out", metavar="PATH", default=os.path.join("cache", "frame_profile.json"),
+                        help="where F4 and exit write the frame profile (default: %(default)s)")
+arg_parser.add_argument("--memory-budget", action="store_true",
+                        help="keep memory use low for 512 MB boards: smaller caches and history, fonts and pages loaded on demand")
+arg_parser.add_argument("--tracemalloc", action="store_true",
+                        help="list the top Python allocation sites in the memory report (slower, uses more memory)")
+arg_parser.add_argument("--memory-out", metavar="PATH", default=os.path.join("cache", "memory_report.json"),
+                        help="where F5 and exit write the memory report (default: %(default)s)")
+args = arg_parser.parse_args()
+
+if args.tracemalloc:
+    # Started before anything else is loaded so every allocation is traced.
+    tracemalloc.start()
+
+# --- CONTENT PACK ---
+# All pages under assets/pages are packed into one file: a magic string, the
+# length of a JSON header, the header (an offset index plus the mtime and size
+# of every source file) and then the page texts back to back. The app maps
+# the pack at startup so opening a page never touches the disk. If any page
+# was added, removed or edited since the pack was built, the loose files are
+# used instead.
+PAGES_DIR = os.path.join("assets", "pages")
+CONTENT_PACK_PATH = os.path.join("assets", "pages.pack")
+CONTENT_PACK_MAGIC = b"HHGPACK1"
+
+def scan_pages():
+    # {"folder/label": path} for every page file.
+    pages = {}
+    if os.path.isdir(PAGES_DIR):
+        for folder in sorted(os.listdir(PAGES_DIR)):
+            folder_path = os.path.join(PAGES_DIR, folder)
+            if not os.path.isdir(folder_path):
+                continue
+            for name in sorted(os.listdir(folder_path)):
+                if name.endswith(".txt"):
+                    pages[folder + "/" + name[:-4]] = os.path.join(folder_path, name)
+    return pages
+
+def page_signature(path):
+    st = os.stat(path)
+    return [st.st_mtime_ns, st.st_size]
+
+def build_content_pack(path=CONTENT_PACK_PATH):
+    index = {}
+    sources = {}
+    blobs = []
+    offset = 0
+    for key, page_path in scan_pages().items():
+        with open(page_path, "rb") as f:
+            data = f.read()
+        index[key] = [offset, len(data)]
+        sources[key] = page_signature(page_path)
+        blobs.append(data)
+        offset += len(data)
+    header = json.dumps({"index": index, "sources": sources}).encode("utf-8")
+    with open(path + ".tmp", "wb") as f:
+        f.write(CONTENT_PACK_MAGIC)
+        f.write(struct.pack("<I", len(header)))
+        f.write(header)
+        for data in blobs:
+            f.write(data)
+    os.replace(path + ".tmp", path)
+    return len(index)
+
+def open_content_pack(path=CONTENT_PACK_PATH):
+    try:
+        with open(path, "rb") as f:
+            pack = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    try:
+        if pack[:len(CONTENT_PACK_MAGIC)] != CONTENT_PACK_MAGIC:
+            raise ValueError("not a content pack")
+        header_start = len(CONTENT_PACK_MAGIC) + 4
+        (header_length,) = struct.unpack("<I", pack[len(CONTENT_PACK_MAGIC):header_start])
+        header = json.loads(pack[header_start:header_start + header_length].decode("utf-8"))
+        pages = scan_pages()
+        sources = header["sources"]
+        if set(pages) != set(sources) or any(page_signature(p) != sources[k] for k, p in pages.items()):
+            raise ValueError("content pack is stale")
+    except (OSError, ValueError, KeyError, struct.error):
+        pack.close()
+        return None
+    data_start = header_start + header_length
+    index = {key: (data_start + offset, length) for key, (offset, length) in header["index"].items()}
+    return {"map": pack, "index": index}
+
+def content_pack_text(pack, key):
+    entry = pack["index"].get(key)
+    if entry is None:
+        return None
+    offset, length = entry
+    text = pack["map"][offset:offset + length].decode("utf-8", "replace")
+    # Same newline handling as reading the file in text mode.
+    return text.replace("\r\n", "\n").replace("\r", "\n")
+
+if args.build_pack:
+    print("Packed %d pages into %s" % (build_content_pack(), CONTENT_PACK_PATH))
+    sys.exit()
+
+# --- BENCHMARK HARNESS ---
+# `--bench` runs every scenario in bench/scenarios in its own child process
+# (`--bench-scenario`) under SDL's dummy video driver at BENCH_RESOLUTION. The
+# child replays the scenario's taps, scrolls and typing against the real main
+# loop, answers Guide questions from the stub backend (or, with --bench-llm
+# http, from the server at OLLAMA_HOST), and writes the time spent on every
+# frame that drew something plus the LLM telemetry summary. The parent prints
+# frame time percentiles per scenario and compares them with
+# bench/baseline.json.
+#
+# A scenario is {"description": ..., "intro": bool, "steps": [...]} where
+# each step starts with the delay in ms before it runs:
+#   [ms, "tap", x, y]   [ms, "wheel", "up" | "down"]   [ms, "type", "text\n"]
+# ("\n" presses Enter, "\b" Backspace).
+BENCH_SCENARIO_DIR = os.path.join("bench", "scenarios")
+BENCH_BASELINE_PATH = os.path.join("bench", "baseline.json")
+BENCH_RESOLUTION = (1024, 600)
+BENCH_TOLERANCE = 1.25      # Slower than baseline by more than this factor is a regression
+BENCH_TYPING_DELAY = 0.05   # Seconds between typed characters
+BENCH_SETTLE_MS = 1000      # Let the last step finish animating before quitting
+bench_frame_times = [] if args.bench_scenario else None
+recorded_steps = [] if args.record_events else None
+last_record_ticks = 0
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = int(math.ceil(pct / 100.0 * len(ordered))) - 1
+    return ordered[max(0, min(rank, len(ordered) - 1))]
+
+def format_llm_summary(summary):
+    outcomes = ", ".join("%d %s" % (count, outcome) for outcome, count in sorted(summary["outcomes"].items()))
+    return "LLM (last {n}): ttft p50 {ttft50} ms, p95 {ttft95} ms; queue p50 {queue50} ms, p95 {queue95} ms; {rate} tok/s; {outcomes}".format(
+        n=summary["requests"], ttft50=summary["ttft_p50_ms"], ttft95=summary["ttft_p95_ms"],
+        queue50=summary["queue_p50_ms"], queue95=summary["queue_p95_ms"],
+        rate=summary["tokens_per_s"], outcomes=outcomes) + (
+        "; {stopped} stopped early, up to {saved:.1f} s saved".format(
+            stopped=summary["stopped_early"], saved=summary["saved_ms"] / 1000.0)
+        if summary.get("stopped_early") else "")
+
+def load_scenario(name):
+    with open(os.path.join(BENCH_SCENARIO_DIR, name + ".json"), "r") as f:
+        return json.load(f)
+
+def run_benchmarks(names, save_baseline=False):
+    if not names:
+        names = sorted(n[:-5] for n in os.listdir(BENCH_SCENARIO_DIR) if n.endswith(".json"))
+    app_dir = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, SDL_VIDEODRIVER="dummy", SDL_AUDIODRIVER="dummy")
+    results = {}
+    llm_summaries = {}
+    for name in names:
+        fd, out_path = tempfile.mkstemp(suffix=".json")
+        os.close(fd)
+        try:
+            subprocess.run([sys.executable, os.path.abspath(__file__), "--bench-scenario", name,
+                            "--bench-out", out_path, "--bench-llm", args.bench_llm], cwd=app_dir, env=env,
+                           check=True, stdout=subprocess.DEVNULL)
+            with open(out_path, "r") as f:
+                out = json.load(f)
+            frame_ms = out["frame_ms"]
+            llm_summaries[name] = out.get("llm")
+        finally:
+            os.remove(out_path)
+        results[name] = {
+            "frames": len(frame_ms),
+            "p50": percentile(frame_ms, 50),
+            "p90": percentile(frame_ms, 90),
+            "p99": percentile(frame_ms, 99),
+            "max": max(frame_ms) if frame_ms else 0.0,
+        }
+    try:
+        with open(BENCH_BASELINE_PATH, "r") as f:
+            baseline = json.load(f)
+    except (OSError, ValueError):
+        baseline = {}
+    regressions = 0
+    print("%-20s %7s %8s %8s %8s %8s  %s" % ("scenario", "frames", "p50 ms", "p90 ms", "p99 ms", "max ms", "vs baseline"))
+    for name, stats in results.items():
+        verdict = "no baseline"
+        if name in baseline:
+            worst = max(stats[k] / baseline[name][k] for k in ("p50", "p90", "p99") if baseline[name][k] > 0)
+            verdict = "%.2fx" % worst
+            if worst > BENCH_TOLERANCE:
+                verdict += "  REGRESSION"
+                regressions += 1
+        print("%-20s %7d %8.2f %8.2f %8.2f %8.2f  %s" % (
+            name, stats["frames"], stats["p50"], stats["p90"], stats["p99"], stats["max"], verdict))
+        if llm_summaries.get(name):
+            print("  " + format_llm_summary(llm_summaries[name]))
+    if save_baseline:
+        baseline.update(results)
+        with open(BENCH_BASELINE_PATH, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print("Baseline saved to " + BENCH_BASELINE_PATH)
+    return 1 if regressions else 0
+
+def replay_scenario(steps):
+    # Runs on its own thread; pygame.event.post is safe to call from here and
+    # also wakes the main loop when it is idling in pygame.event.wait().
+    center = (WIDTH // 2, HEIGHT // 2)
+    for step in steps:
+        time.sleep(step[0] / 1000.0)
+        if step[1] == "tap":
+            pos = (step[2], step[3])
+            pygame.event.post(pygame.event.Event(pygame.MOUSEBUTTONDOWN, pos=pos, button=1))
+            pygame.event.post(pygame.event.Event(pygame.MOUSEBUTTONUP, pos=pos, button=1))
+        elif step[1] == "wheel":
+            button = 4 if step[2] == "up" else 5
+            pygame.event.post(pygame.event.Event(pygame.MOUSEBUTTONDOWN, pos=center, button=button))
+        elif step[1] == "type":
+            for char in step[2]:
+                if char == "\n":
+                    key, char = pygame.K_RETURN, "\r"
+                elif char == "\b":
+                    key, char = pygame.K_BACKSPACE, ""
+                else:
+                    key = ord(char.lower())
+                pygame.event.post(pygame.event.Event(pygame.KEYDOWN, key=key, unicode=char, mod=0, scancode=0))
+                time.sleep(BENCH_TYPING_DELAY)
+    time.sleep(BENCH_SETTLE_MS / 1000.0)
+    pygame.event.post(pygame.event.Event(pygame.QUIT))
+
+def record_event(event):
+    global last_record_ticks
+    if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
+        step = ["tap", event.pos[0], event.pos[1]]
+    elif event.type == pygame.MOUSEBUTTONDOWN and event.button in (4, 5):
+        step = ["wheel", "up" if event.button == 4 else "down"]
+    elif event.type == pygame.KEYDOWN and event.key == pygame.K_RETURN:
+        step = ["type", "\n"]
+    elif event.type == pygame.KEYDOWN and event.key == pygame.K_BACKSPACE:
+        step = ["type", "\b"]
+    elif event.type == pygame.KEYDOWN and event.unicode:
+        step = ["type", event.unicode]
+    else:
+        return
+    now = pygame.time.get_ticks()
+    recorded_steps.append([now - last_record_ticks] + step)
+    last_record_ticks = now
+
+def save_recording(path):
+    # Same layout as the hand-written scenarios: one step per line.
+    steps = ",\n".join("    " + json.dumps(step) for step in recorded_steps)
+    with open(path, "w") as f:
+        f.write('{\n  "description": "Recorded session",\n  "intro": false,\n'
+                '  "resolution": %s,\n  "steps": [\n%s\n  ]\n}\n' % (json.dumps([WIDTH, HEIGHT]), steps))
+
+if args.bench is not None:
+    sys.exit(run_benchmarks(args.bench, args.bench_save_baseline))
+
+content_pack = open_content_pack()
+
+# Benchmarks and batch commands never show a window.
+HEADLESS = bool(args.bench_scenario or args.bench_wrap is not None or args.pregenerate or args.check_canned)
+
+if HEADLESS:
+    os.environ["SDL_VIDEODRIVER"] = "dummy"
+    os.environ["SDL_AUDIODRIVER"] = "dummy"
 
 pygame.init()
 
@@ -11,7 +323,10 @@ pygame.init()
 pygame.mouse.set_visible(False)
 
 # --- FULLSCREEN SETUP ---
-screen = pygame.display.set_mode((0, 0), pygame.FULLSCREEN)
+if HEADLESS:
+    screen = pygame.display.set_mode(BENCH_RESOLUTION)
+else:
+    screen = pygame.display.set_mode((0, 0), pygame.FULLSCREEN)
 WIDTH, HEIGHT = screen.get_size()
 pygame.display.set_caption("Interactive Hitchhiker's Guide")
 # Always in full screen mode on the Pi touchscreen
@@ -75,16 +390,318 @@ buttons = [
      "rect": pygame.Rect(MAIN_BUTTON_X, top_button_y + 5 * button_height, MAIN_BUTTON_WIDTH, button_height)},
 ]
 
-# Fonts
-font_main = pygame.font.SysFont("Arial", 16, bold=True)
-font_anim = pygame.font.SysFont("Arial", 16, bold=True)
-font_popup = pygame.font.Font("assets/fonts/Orbitron-Regular.ttf", 16)
-font_close = pygame.font.Font("assets/fonts/Orbitron-Regular.ttf", 20)
-# New font for arrow buttons (using Arial, size 24, bold)
-font_arrows = pygame.font.SysFont("Arial", 24, bold=True)
+# --- ASSET CACHE ---
+# Images are decoded, converted for the display and scaled once; the result
+# is kept under ASSET_CACHE_DIR as raw pixels, keyed by a hash of the source
+# file, the target size and the pixel format, so later boots skip both the
+# PNG decoder and smoothscale. The manifest remembers each source's size so
+# the target size is known without decoding, and which hash each path had
+# last, so variants of an image that has since changed are deleted.
+# Font files are read once and every size is opened from the same bytes.
+ASSET_CACHE_DIR = os.path.join("cache", "assets")
+ASSET_MANIFEST_PATH = os.path.join(ASSET_CACHE_DIR, "manifest.json")
+asset_manifest = None    # {"sizes": {hash: [w, h]}, "paths": {path: hash}}
+asset_format = None      # Pixel format of converted images, part of the key
+asset_stats = {"hits": 0, "misses": 0}
+font_files = {}          # path -> file contents
+
+def load_asset_manifest():
+    global asset_manifest
+    if asset_manifest is None:
+        try:
+            with open(ASSET_MANIFEST_PATH, "r") as f:
+                asset_manifest = json.load(f)
+        except (OSError, ValueError):
+            asset_manifest = None
+        if not (isinstance(asset_manifest, dict) and "sizes" in asset_manifest and "paths" in asset_manifest):
+            asset_manifest = {"sizes": {}, "paths": {}}
+    return asset_manifest
+
+def image_format():
+    global asset_format
+    if asset_format is None:
+        probe = pygame.Surface((1, 1), pygame.SRCALPHA).convert_alpha()
+        asset_format = "%d-%x-%x-%x-%x" % ((probe.get_bitsize(),) + tuple(probe.get_masks()))
+    return asset_format
+
+def image_variant_path(digest, size):
+    return os.path.join(ASSET_CACHE_DIR, "%s-%dx%d-%s.rgba" % (digest, size[0], size[1], image_format()))
+
+def load_image(path, size=None):
+    # `size` is the target size, or a function of the source size returning it.
+    with open(path, "rb") as f:
+        data = f.read()
+    digest = hashlib.sha256(data).hexdigest()[:32]
+    manifest = load_asset_manifest()
+    source_size = manifest["sizes"].get(digest)
+    if source_size is not None:
+        target = tuple(size(tuple(source_size)) if callable(size) else size or source_size)
+        try:
+            with open(image_variant_path(digest, target), "rb") as f:
+                pixels = f.read()
+            surf = pygame.image.frombytes(pixels, target, "RGBA").convert_alpha()
+            asset_stats["hits"] += 1
+            return surf
+        except (OSError, ValueError):
+            pass
+    asset_stats["misses"] += 1
+    surf = pygame.image.load(io.BytesIO(data), path).convert_alpha()
+    source_size = surf.get_size()
+    target = tuple(size(source_size) if callable(size) else size or source_size)
+    if target != source_size:
+        surf = pygame.transform.smoothscale(surf, target)
+    try:
+        os.makedirs(ASSET_CACHE_DIR, exist_ok=True)
+        variant_path = image_variant_path(digest, target)
+        with open(variant_path + ".tmp", "wb") as f:
+            f.write(pygame.image.tobytes(surf, "RGBA"))
+        os.replace(variant_path + ".tmp", variant_path)
+        previous = manifest["paths"].get(path)
+        if previous is not None and previous != digest:
+            for name in os.listdir(ASSET_CACHE_DIR):
+                if name.startswith(previous + "-"):
+                    os.remove(os.path.join(ASSET_CACHE_DIR, name))
+            manifest["sizes"].pop(previous, None)
+        manifest["sizes"][digest] = list(source_size)
+        manifest["paths"][path] = digest
+        with open(ASSET_MANIFEST_PATH + ".tmp", "w") as f:
+            json.dump(manifest, f)
+        os.replace(ASSET_MANIFEST_PATH + ".tmp", ASSET_MANIFEST_PATH)
+    except OSError:
+        pass
+    return surf
+
+def open_font_file(path, size):
+    data = font_files.get(path)
+    if data is None:
+        with open(path, "rb") as f:
+            data = font_files[path] = f.read()
+    return pygame.font.Font(io.BytesIO(data), size)
+
+def asset_cache_report():
+    return "Asset cache: {hits} hits, {misses} misses, {fonts} font files read".format(
+        fonts=len(font_files), **asset_stats)
+
+# Fonts are opened on first use and shared by every name with the same face
+# and size. The warm-up thread opens them all while the splash screen shows,
+# except in --memory-budget mode, where the popup fonts wait for a popup.
+FONT_SPECS = {
+    "main": ("Arial", 16, True),
+    "anim": ("Arial", 16, True),
+    "popup": ("assets/fonts/Orbitron-Regular.ttf", 16, False),
+    "close": ("assets/fonts/Orbitron-Regular.ttf", 20, False),
+    # Arrow buttons (Arial, size 24, bold)
+    "arrows": ("Arial", 24, True),
+}
+MENU_FONTS = ["main", "anim"]
+loaded_fonts = {}   # (face, size, bold) -> pygame.font.Font
+
+def get_font(name):
+    spec = FONT_SPECS[name]
+    font = loaded_fonts.get(spec)
+    if font is None:
+        face, size, bold = spec
+        if face.endswith(".ttf"):
+            font = open_font_file(face, size)
+        else:
+            font = pygame.font.SysFont(face, size, bold=bold)
+        loaded_fonts[spec] = font
+    return font
+
+def load_fonts(names=FONT_SPECS):
+    for name in names:
+        get_font(name)
 
 clock = pygame.time.Clock()
 
+# --- FRAME PROFILER ---
+# Every pass of the main loop records how long each phase took into a ring
+# buffer. "wrap_text" and "glyphs" are measured inside other phases and are
+# not added to the frame total; "wait" is time spent idle between frames.
+# F3 toggles an overlay with the fps, the slowest recent phases and the LLM
+# telemetry summary, F4 writes the buffer to --profile-out, which also
+# happens on exit.
+PROFILE_PHASES = ["wait", "animation", "events", "stream", "draw_main", "popup", "hud", "present"]
+PROFILE_SUBPHASES = ["wrap_text", "glyphs"]
+PROFILE_RING_SIZE = 120 if args.memory_budget else 600   # Frames kept for the JSON dump
+PROFILE_HUD_FRAMES = 60      # Frames the overlay looks back over
+PROFILE_HUD_REFRESH_MS = 500
+PROFILE_HUD_RECT = pygame.Rect(10, 10, 240, 110)
+profile_frames = deque(maxlen=PROFILE_RING_SIZE)
+profile_current = {}
+profile_mark = time.perf_counter()
+profile_hud = args.hud
+profile_hud_drawn_ticks = -PROFILE_HUD_REFRESH_MS
+
+def profile_start_frame():
+    global profile_mark
+    profile_current.clear()
+    profile_mark = time.perf_counter()
+
+def profile_phase(name):
+    # Charge the time since the previous mark to `name`.
+    global profile_mark
+    now = time.perf_counter()
+    profile_current[name] = profile_current.get(name, 0.0) + (now - profile_mark) * 1000.0
+    profile_mark = now
+
+def profile_add(name, ms):
+    profile_current[name] = profile_current.get(name, 0.0) + ms
+
+def profile_end_frame():
+    frame = {name: round(ms, 3) for name, ms in profile_current.items()}
+    frame["total"] = round(sum(ms for name, ms in profile_current.items()
+                               if name in PROFILE_PHASES and name != "wait"), 3)
+    profile_frames.append(frame)
+
+def profile_worst_phases(count=3):
+    recent = list(profile_frames)[-PROFILE_HUD_FRAMES:]
+    worst = {}
+    for frame in recent:
+        for name, ms in frame.items():
+            if name not in ("wait", "total"):
+                worst[name] = max(worst.get(name, 0.0), ms)
+    return sorted(worst.items(), key=lambda item: item[1], reverse=True)[:count]
+
+def draw_profile_hud(surface):
+    pacing = get_pacing_state()
+    lines = ["%.1f fps  %s" % (pacing["fps"], pacing["state"])]
+    lines += ["%-10s %6.2f ms" % (name, ms) for name, ms in profile_worst_phases()]
+    llm_summary = llm_metrics_summary()
+    if llm_summary:
+        lines.append("LLM ttft %.0f ms  %s tok/s" % (llm_summary["ttft_p50_ms"], llm_summary["tokens_per_s"]))
+    pygame.draw.rect(surface, (0, 0, 0), PROFILE_HUD_RECT)
+    y = PROFILE_HUD_RECT.y + 4
+    for line in lines:
+        # Rendered directly so the overlay does not churn the text cache.
+        surface.blit(get_font("main").render(line, True, (0, 255, 0)), (PROFILE_HUD_RECT.x + 6, y))
+        y += get_font("main").get_linesize()
+
+def profile_dump(path):
+    frames = list(profile_frames)
+    summary = {}
+    for name in PROFILE_PHASES + PROFILE_SUBPHASES + ["total"]:
+        values = [frame.get(name, 0.0) for frame in frames]
+        if not any(values):
+            continue
+        summary[name] = {
+            "mean": round(sum(values) / len(values), 3),
+            "p95": round(percentile(values, 95), 3),
+            "max": round(max(values), 3),
+        }
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump({"phases": PROFILE_PHASES, "subphases": PROFILE_SUBPHASES, "startup": startup_stats,
+                   "pacing": get_pacing_state(), "summary": summary, "frames": frames}, f, indent=1)
+    print("Frame profile: %d frames written to %s" % (len(frames), path))
+
+# --- MEMORY REPORT ---
+# Each time the app settles into idle pacing, the resident set size is sampled
+# for the mode on screen (menu, page, guide, search) together with the size of
+# every cache. With --tracemalloc the sample also lists the Python allocation
+# sites holding the most memory; pygame surfaces live outside the Python heap
+# and only show up in the RSS and the cache sizes. F5 samples the current mode
+# and writes the report to --memory-out, which also happens on exit.
+MEMORY_TOP_SITES = 10
+memory_samples = {}   # mode -> latest sample, plus the highest RSS seen in it
+
+def read_rss_kb():
+    # Current and peak resident set size, from /proc on Linux (and so the Pi).
+    values = {}
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(("VmRSS:", "VmHWM:")):
+                    values[line.split(":")[0]] = int(line.split()[1])
+    except OSError:
+        pass
+    return values.get("VmRSS"), values.get("VmHWM")
+
+def memory_cache_sizes():
+    return {
+        "text_cache_bytes": text_cache_stats["bytes"],
+        "glyph_advances": sum(len(advances) for advances in glyph_advances.values()),
+        "fonts": len(loaded_fonts),
+        "page_tile_bytes": page_tile_bytes(page_layout) if page_layout else 0,
+        "preloaded_page_chars": sum(len(text) for text in preloaded_pages.values()),
+        "conversation_entries": len(llm_conversation),
+        "chat_history_messages": len(chat_history),
+        "profile_frames": len(profile_frames),
+    }
+
+def memory_sample(mode):
+    rss_kb, peak_kb = read_rss_kb()
+    previous = memory_samples.get(mode, {})
+    sample = {
+        "rss_kb": rss_kb,
+        "max_rss_kb": max(filter(None, [rss_kb, previous.get("max_rss_kb")]), default=None),
+        "peak_rss_kb": peak_kb,
+        "seconds": round(time.perf_counter() - process_start, 1),
+        "caches": memory_cache_sizes(),
+    }
+    if tracemalloc.is_tracing():
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+        ])
+        sample["traced_kb"] = round(tracemalloc.get_traced_memory()[0] / 1024.0, 1)
+        sample["top"] = [{
+            "site": "%s:%d" % (stat.traceback[0].filename, stat.traceback[0].lineno),
+            "kb": round(stat.size / 1024.0, 1),
+            "blocks": stat.count,
+        } for stat in snapshot.statistics("lineno")[:MEMORY_TOP_SITES]]
+    memory_samples[mode] = sample
+
+def memory_report():
+    modes = ", ".join("%s %s" % (mode, "%.1f MB" % (sample["max_rss_kb"] / 1024.0) if sample["max_rss_kb"] else "n/a")
+                      for mode, sample in memory_samples.items())
+    return "Memory: highest RSS per mode: %s%s" % (modes or "none sampled",
+                                                    " (budget mode)" if args.memory_budget else "")
+
+def memory_dump(path):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump({"budget_mode": args.memory_budget, "tracing": tracemalloc.is_tracing(),
+                   "modes": memory_samples}, f, indent=1)
+    print("Memory report: %d modes written to %s" % (len(memory_samples), path))
+
+# --- TEXT SURFACE CACHE ---
+# Labels that never change are rasterized once and reused every frame.
+# Entries are evicted least-recently-used first once the budget is exceeded.
+TEXT_CACHE_BUDGET = (1 if args.memory_budget else 4) * 1024 * 1024  # bytes of pixel data kept in the cache
+text_cache = OrderedDict()
+text_cache_stats = {"hits": 0, "misses": 0, "evictions": 0, "bytes": 0}
+
+def render_text(font, text, antialias, color):
+    key = (font, text, antialias, tuple(color))
+    surf = text_cache.get(key)
+    if surf is not None:
+        text_cache.move_to_end(key)
+        text_cache_stats["hits"] += 1
+        return surf
+    text_cache_stats["misses"] += 1
+    render_start = time.perf_counter()
+    surf = font.render(text, antialias, color)
+    profile_add("glyphs", (time.perf_counter() - render_start) * 1000.0)
+    size = surf.get_width() * surf.get_height() * surf.get_bytesize()
+    if size <= TEXT_CACHE_BUDGET:
+        text_cache[key] = surf
+        text_cache_stats["bytes"] += size
+        while text_cache_stats["bytes"] > TEXT_CACHE_BUDGET:
+            _, old = text_cache.popitem(last=False)
+            text_cache_stats["bytes"] -= old.get_width() * old.get_height() * old.get_bytesize()
+            text_cache_stats["evictions"] += 1
+    return surf
+
+def text_cache_report():
+    return "Text cache: {hits} hits, {misses} misses, {evictions} evictions, {bytes} bytes in {n} surfaces".format(
+        n=len(text_cache), **text_cache_stats)
+
 # --- QUIT BUTTON SETUP ---
 QUIT_BUTTON_WIDTH = 80
 QUIT_BUTTON_HEIGHT = 40
@@ -96,25 +713,106 @@ llm_input_text = ""       # Text currently entered by the user
 llm_conversation = []     # Conversation history (list of strings)
 guide_scroll_offset = 0   # Scroll offset for the conversation area in guide mode
 
-# Global list to track LLM threads
-llm_threads = []
-
 # --- Constants for scroll elements ---
 SCROLLBAR_WIDTH = 6       # Narrow scroll bar width
 SCROLL_BTN_WIDTH = 50     # Scroll arrow button width
 SCROLL_BTN_HEIGHT = 50    # Scroll arrow button height
 
 # --- BUILD PROMPT FUNCTION ---
-def build_prompt(user_query):
-    system_prompt = (
-        "You are the Hitchhiker's Guide to the Galaxy. "
-        "Respond in a quirky, dry, and witty style as if written by Douglas Adams. "
-        "Keep your answers extremely short—only one or two sentences."
-    )
-    return system_prompt + "\n" + user_query
+SYSTEM_PROMPT = (
+    "You are the Hitchhiker's Guide to the Galaxy. "
+    "Respond in a quirky, dry, and witty style as if written by Douglas Adams. "
+    "Keep your answers extremely short—only one or two sentences."
+)
+
+def build_messages(user_query, history):
+    return [{"role": "system", "content": SYSTEM_PROMPT}] + history + [{"role": "user", "content": user_query}]
+
+def build_prompt(messages):
+    # The CLI cannot keep a chat session, so earlier turns are written out
+    # in front of the question.
+    lines = []
+    for message in messages[:-1]:
+        if message["role"] == "user":
+            lines.append("You: " + message["content"])
+        elif message["role"] == "assistant":
+            lines.append("Guide: " + message["content"])
+        else:
+            lines.append(message["content"])
+    lines.append(messages[-1]["content"])
+    return "\n".join(lines)
 
 # --- HELPER FUNCTION: WORD WRAPPING ---
+# Measuring the growing line with font.size() after every word is quadratic
+# in the line length. Instead, the break is first estimated in one pass from
+# per-character advances (font.metrics, cached per font). Kerning and
+# sub-pixel glyph positions make that estimate off by a pixel or two now and
+# then, so the estimated line and the line with one more word are measured
+# exactly, and the break moves a word at a time until both checks agree. A
+# line only gets wider as words are added, so the result is always the same
+# as measuring every prefix (wrap_text_reference, kept for --bench-wrap).
+GLYPH_ADVANCE_MAX_CHARS = 256 if args.memory_budget else 2048   # Per font; the table starts over past this
+glyph_advances = {}   # font -> {character: advance in pixels}
+
+def estimate_width(font, text):
+    advances = glyph_advances.get(font)
+    if advances is None:
+        advances = glyph_advances[font] = {}
+    width = 0
+    for char in text:
+        advance = advances.get(char)
+        if advance is None:
+            if len(advances) >= GLYPH_ADVANCE_MAX_CHARS:
+                advances.clear()
+            metrics = font.metrics(char)
+            if metrics and metrics[0] is not None:
+                advance = metrics[0][4]
+            else:
+                advance = font.size(char)[0]
+            advances[char] = advance
+        width += advance
+    return width
+
 def wrap_text(text, font, max_width):
+    wrap_start = time.perf_counter()
+    words = text.split(' ')
+    space = estimate_width(font, " ")
+    lines = []
+    current_line = ""
+    i = 0
+    while i < len(words):
+        if not current_line:
+            # A line always takes its first word, even one too wide to fit.
+            current_line = words[i]
+            i += 1
+            continue
+        width = estimate_width(font, current_line)
+        count = 0
+        while i + count < len(words):
+            width += space + estimate_width(font, words[i + count])
+            if width > max_width:
+                break
+            count += 1
+        if count and font.size(" ".join([current_line] + words[i:i + count]))[0] > max_width:
+            count -= 1
+            while count and font.size(" ".join([current_line] + words[i:i + count]))[0] > max_width:
+                count -= 1
+        else:
+            while i + count < len(words) and font.size(" ".join([current_line] + words[i:i + count + 1]))[0] <= max_width:
+                count += 1
+        if count:
+            current_line = " ".join([current_line] + words[i:i + count])
+            i += count
+        if i < len(words):
+            lines.append(current_line)
+            current_line = words[i]
+            i += 1
+    if current_line:
+        lines.append(current_line)
+    profile_add("wrap_text", (time.perf_counter() - wrap_start) * 1000.0)
+    return lines
+
+def wrap_text_reference(text, font, max_width):
     words = text.split(' ')
     lines = []
     current_line = ""
@@ -130,55 +828,775 @@ def wrap_text(text, font, max_width):
         lines.append(current_line)
     return lines
 
-# --- STREAMING LLM FUNCTION USING Ollama with tinyllama ---
-def llm_thread_stream(prompt, response_index):
+def run_wrap_benchmark(paths, widths, repeat=5):
+    load_fonts()
+    if not paths:
+        paths = list(scan_pages().values())
+    fonts = [("Orbitron 16", get_font("popup")), ("Orbitron 20", get_font("close")), ("Arial 16 bold", get_font("main"))]
+    mismatches = 0
+    print("%-28s %-14s %6s %11s %11s %8s" % ("file", "font", "width", "before ms", "after ms", "speedup"))
+    for path in paths:
+        with open(path, "r", encoding="utf-8", errors="replace") as f:
+            paragraphs = f.read().splitlines()
+        for font_name, font in fonts:
+            for width in widths:
+                timings = []
+                for wrap in (wrap_text_reference, wrap_text):
+                    best = None
+                    for _ in range(repeat):
+                        glyph_advances.clear()
+                        start = time.perf_counter()
+                        result = [wrap(line, font, width) for line in paragraphs]
+                        elapsed = (time.perf_counter() - start) * 1000.0
+                        best = elapsed if best is None else min(best, elapsed)
+                    timings.append(best)
+                    if wrap is wrap_text_reference:
+                        expected = result
+                if result != expected:
+                    mismatches += 1
+                print("%-28s %-14s %6d %11.2f %11.2f %7.1fx%s" % (
+                    os.path.basename(path)[-28:], font_name, width, timings[0], timings[1],
+                    timings[0] / timings[1] if timings[1] else 0.0, "  DIFFERENT OUTPUT" if result != expected else ""))
+    return 1 if mismatches else 0
+
+# --- OLLAMA BACKEND SETTINGS ---
+# "http" streams from the local Ollama server over pooled keep-alive
+# connections and falls back to the CLI when the server cannot be reached.
+# "cli" always runs a new `ollama run` process per question.
+# "stub" streams a canned answer and is what the benchmarks use.
+LLM_BACKEND = args.bench_llm if args.bench_scenario else "http"
+OLLAMA_MODEL = "tinyllama"
+OLLAMA_BIN = "/usr/local/bin/ollama"
+OLLAMA_HOST = os.environ.get("OLLAMA_HOST", "127.0.0.1:11434")
+OLLAMA_KEEP_ALIVE = "30m"   # How long the server keeps the model loaded after a request
+OLLAMA_TIMEOUT = 120        # Seconds to wait on a silent connection
+OLLAMA_POOL_SIZE = 1 if args.memory_budget else 2   # Idle connections kept open for reuse
+LLM_READ_CHUNK = 4096       # Bytes read from the CLI per system call
+STUB_ANSWER = ("The answer is forty-two, although the Guide notes that the question "
+               "was never entirely clear. Bring a towel.")
+STUB_TOKEN_DELAY = 0.03     # Seconds between stub tokens
+
+OLLAMA_STATS_KEYS = ("eval_count", "eval_duration", "prompt_eval_count", "prompt_eval_duration", "load_duration",
+                     "done_reason")
+
+ollama_pool = []            # Idle http.client connections to the Ollama server
+ollama_pool_lock = threading.Lock()
+
+def ollama_address():
+    host = OLLAMA_HOST if "://" in OLLAMA_HOST else "http://" + OLLAMA_HOST
+    parts = urlsplit(host)
+    return parts.hostname or "127.0.0.1", parts.port or 11434
+
+def ollama_connection():
+    with ollama_pool_lock:
+        if ollama_pool:
+            return ollama_pool.pop()
+    host, port = ollama_address()
+    return http.client.HTTPConnection(host, port, timeout=OLLAMA_TIMEOUT)
+
+def ollama_release(conn):
+    with ollama_pool_lock:
+        if len(ollama_pool) < OLLAMA_POOL_SIZE:
+            ollama_pool.append(conn)
+            return
+    conn.close()
+
+def ollama_request(path, payload, request=None):
+    # Returns (connection, response). A pooled connection the server has already
+    # closed fails on first use, so that case is retried once on a fresh one.
+    # The connection is attached to the request before anything is sent:
+    # Ollama sends no headers until the first token, and cancelling has to
+    # work while it loads the model and reads the prompt.
+    body = json.dumps(payload).encode("utf-8")
+    headers = {"Content-Type": "application/json", "Connection": "keep-alive"}
+    for attempt in range(2):
+        conn = ollama_connection()
+        try:
+            if conn.sock is None:
+                conn.connect()
+            llm_attach(request, conn)
+            conn.request("POST", path, body, headers)
+            return conn, conn.getresponse()
+        except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+            conn.close()
+            if attempt or llm_stopping(request):
+                raise   # Not a stale connection: a retry failed too, or we shut it down
+        except Exception:
+            conn.close()
+            raise
+
+def ollama_http_chat(messages, request=None):
+    # The server keeps the evaluated context of the last request, so when the
+    # earlier messages are unchanged only the new turn has to be processed.
+    conn, response = ollama_request("/api/chat", {
+        "model": OLLAMA_MODEL,
+        "messages": messages,
+        "stream": True,
+        "keep_alive": OLLAMA_KEEP_ALIVE,
+        "options": {"num_predict": ANSWER_MAX_TOKENS},
+    }, request)
+    try:
+        if response.status != 200:
+            raise RuntimeError("Ollama returned HTTP %d: %s" % (
+                response.status, response.read().decode("utf-8", "replace").strip()))
+        # The body is one JSON object per line until "done" is set.
+        done = False
+        for line in response:
+            if not line.strip():
+                continue
+            chunk = json.loads(line)
+            if chunk.get("error"):
+                raise RuntimeError(chunk["error"])
+            content = chunk.get("message", {}).get("content")
+            if content:
+                yield content
+            if chunk.get("done"):
+                done = True
+                if request is not None:
+                    request["server_stats"] = {key: chunk[key] for key in OLLAMA_STATS_KEYS if key in chunk}
+                break
+        if not done and not llm_stopping(request):
+            # A connection dropped mid-answer can end the body without an error.
+            raise RuntimeError("Ollama closed the connection before the answer was finished")
+        response.read()
+    except BaseException:
+        conn.close()
+        raise
+    if llm_stopping(request):
+        conn.close()  # Its socket was shut down by llm_cancel or the answer budget
+    else:
+        ollama_release(conn)
+
+def ollama_cli_generate(prompt, request=None):
+    process = subprocess.Popen(
+        [OLLAMA_BIN, "run", OLLAMA_MODEL, prompt],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    llm_attach(request, process)
+    # Read whatever output is available (up to a chunk) rather than one
+    # character at a time; multi-byte characters may straddle two reads.
+    decoder = codecs.getincrementaldecoder("utf-8")("replace")
+    fd = process.stdout.fileno()
+    finished = False
     try:
-        process = subprocess.Popen(
-            ["/usr/local/bin/ollama", "run", "tinyllama", prompt],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            bufsize=1,
-            universal_newlines=True
-        )
-        accumulator = ""
-        # Read output one character at a time.
         while True:
-            char = process.stdout.read(1)
-            if char == "" and process.poll() is not None:
+            data = os.read(fd, LLM_READ_CHUNK)
+            if not data:
                 break
-            if char:
-                accumulator += char
-                # Update conversation entry continuously.
-                llm_conversation[response_index] = "Guide: " + accumulator
+            text = decoder.decode(data)
+            if text:
+                yield text
+        finished = True
+        text = decoder.decode(b"", final=True)
+        if text:
+            yield text
+    finally:
+        if not finished and process.poll() is None:
+            process.kill()   # Closed early, e.g. by the answer budget
         process.stdout.close()
         process.wait()
+
+def stub_generate(messages, request=None):
+    cancel = request["cancel"] if request is not None else threading.Event()
+    for i, word in enumerate(STUB_ANSWER.split(" ")):
+        if cancel.wait(STUB_TOKEN_DELAY):
+            return
+        yield word if i == 0 else " " + word
+
+def llm_generate(messages, request=None):
+    if LLM_BACKEND == "stub":
+        yield from stub_generate(messages, request)
+        return
+    if LLM_BACKEND == "http":
+        try:
+            stream = ollama_http_chat(messages, request)
+            first = next(stream, None)
+        except ConnectionError:
+            if llm_stopping(request):
+                return   # Shut down on purpose; starting the CLI would only begin again
+            # Server not running (or not reachable): use the CLI instead.
+            if request is not None:
+                request["backend"] = "cli"
+            yield from ollama_cli_generate(build_prompt(messages), request)
+            return
+        if first is not None:
+            yield first
+            yield from stream
+        return
+    yield from ollama_cli_generate(build_prompt(messages), request)
+
+# --- LLM RESPONSE CACHE ---
+# Answers are stored on disk, one JSON file per question, keyed on the
+# normalized question, the system prompt and the model. Entries older than
+# LLM_CACHE_MAX_AGE are dropped, and the least recently used ones go first
+# once the store grows past LLM_CACHE_MAX_BYTES.
+LLM_CACHE_ENABLED = not (args.no_llm_cache or args.bench_scenario)
+LLM_CACHE_DIR = os.path.join("cache", "llm")
+LLM_CACHE_MAX_BYTES = 2 * 1024 * 1024
+LLM_CACHE_MAX_AGE = 30 * 24 * 3600   # seconds
+llm_cache_lock = threading.Lock()
+llm_cache_stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+def normalize_query(query):
+    query = re.sub(r"[^\w\s]", " ", query.lower())
+    return " ".join(query.split())
+
+def llm_cache_path(query):
+    key = "\n".join((OLLAMA_MODEL, SYSTEM_PROMPT, normalize_query(query)))
+    return os.path.join(LLM_CACHE_DIR, hashlib.sha256(key.encode("utf-8")).hexdigest() + ".json")
+
+def llm_cache_get(query):
+    if not LLM_CACHE_ENABLED:
+        return None
+    path = llm_cache_path(query)
+    try:
+        with open(path, "r") as f:
+            entry = json.load(f)
+        if time.time() - entry["created"] > LLM_CACHE_MAX_AGE:
+            raise KeyError("expired")
+        os.utime(path)   # Keep recently used answers around longest
+    except (OSError, ValueError, KeyError):
+        with llm_cache_lock:
+            llm_cache_stats["misses"] += 1
+        return None
+    with llm_cache_lock:
+        llm_cache_stats["hits"] += 1
+    return entry["answer"]
+
+def llm_cache_put(query, answer):
+    if not LLM_CACHE_ENABLED or not answer.strip():
+        return
+    path = llm_cache_path(query)
+    entry = {"query": normalize_query(query), "model": OLLAMA_MODEL,
+             "created": time.time(), "answer": answer}
+    with llm_cache_lock:
+        try:
+            os.makedirs(LLM_CACHE_DIR, exist_ok=True)
+            with open(path + ".tmp", "w") as f:
+                json.dump(entry, f)
+            os.replace(path + ".tmp", path)
+            llm_cache_stats["stores"] += 1
+            llm_cache_evict()
+        except OSError:
+            pass
+
+def llm_cache_evict():
+    # Called with llm_cache_lock held.
+    entries = []
+    for name in os.listdir(LLM_CACHE_DIR):
+        path = os.path.join(LLM_CACHE_DIR, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        entries.append((st.st_mtime, st.st_size, path))
+    entries.sort()
+    now = time.time()
+    total = sum(size for _, size, _ in entries)
+    for mtime, size, path in entries:
+        if total <= LLM_CACHE_MAX_BYTES and now - mtime <= LLM_CACHE_MAX_AGE:
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        llm_cache_stats["evictions"] += 1
+
+def clear_llm_cache():
+    with llm_cache_lock:
+        if os.path.isdir(LLM_CACHE_DIR):
+            for name in os.listdir(LLM_CACHE_DIR):
+                try:
+                    os.remove(os.path.join(LLM_CACHE_DIR, name))
+                except OSError:
+                    pass
+
+def llm_cache_report():
+    return "LLM cache: {hits} hits, {misses} misses, {stores} stores, {evictions} evictions".format(**llm_cache_stats)
+
+if args.clear_llm_cache:
+    clear_llm_cache()
+
+# --- STREAM HAND-OFF TO THE UI THREAD ---
+# LLM threads never touch llm_conversation. They append text to a pending list
+# under a lock, and the main loop drains it once per frame. Output is tagged
+# with the conversation session so that text from a closed popup is dropped.
+llm_stream_lock = threading.Lock()
+llm_stream_pending = []   # (session, response_index, text, replace) waiting for the UI
+llm_session = 0           # Bumped whenever llm_conversation is reset
+llm_conversation_base = 0 # Entries spilled from the front of llm_conversation this session
+
+def llm_stream_push(session, response_index, text, replace=False):
+    with llm_stream_lock:
+        llm_stream_pending.append((session, response_index, text, replace))
+
+def llm_stream_waiting():
+    with llm_stream_lock:
+        return bool(llm_stream_pending)
+
+def llm_stream_drain():
+    global llm_stream_pending
+    with llm_stream_lock:
+        if not llm_stream_pending:
+            return False
+        pending = llm_stream_pending
+        llm_stream_pending = []
+    # Coalesce everything that arrived since the last frame into one update
+    # per conversation entry. Threads count entries from the start of the
+    # session, so spilled entries shift the index.
+    updates = {}
+    for session, response_index, text, replace in pending:
+        response_index -= llm_conversation_base
+        if session != llm_session or not 0 <= response_index < len(llm_conversation):
+            continue
+        if replace:
+            updates[response_index] = (text, [])
+        else:
+            updates.setdefault(response_index, (None, []))[1].append(text)
+    for response_index, (base, pieces) in updates.items():
+        if base is None:
+            base = llm_conversation[response_index]
+        llm_conversation[response_index] = base + "".join(pieces)
+    return bool(updates)
+
+# --- CONVERSATION VIEW ---
+# Wrapped lines are cached per conversation entry and only entries whose text
+# changed (normally just the answer being streamed) are wrapped again. Only
+# lines inside the conversation area are drawn. Past LLM_HISTORY_MAX_ENTRIES
+# the oldest turns are dropped; they are not kept anywhere, since the kiosk
+# should not collect its visitors' conversations.
+LLM_HISTORY_MAX_ENTRIES = 20 if args.memory_budget else 60
+conversation_layout = []  # {"text", "lines"} for each entry of llm_conversation
+
+def update_conversation_layout(font, max_width):
+    del conversation_layout[len(llm_conversation):]
+    for i, text in enumerate(llm_conversation):
+        if i < len(conversation_layout):
+            entry = conversation_layout[i]
+            if entry["text"] is text or entry["text"] == text:
+                continue
+            entry["text"] = text
+            entry["lines"] = wrap_text(text, font, max_width)
+        else:
+            conversation_layout.append({"text": text, "lines": wrap_text(text, font, max_width)})
+    return sum(len(entry["lines"]) for entry in conversation_layout) * (font.get_height() + 5)
+
+def draw_conversation(surface, font, area_rect, scroll_offset):
+    line_height = font.get_height() + 5
+    y_offset = area_rect.top - scroll_offset
+    for entry in conversation_layout:
+        entry_height = len(entry["lines"]) * line_height
+        if y_offset + entry_height > area_rect.top and y_offset < area_rect.bottom:
+            for wline in entry["lines"]:
+                if y_offset + line_height > area_rect.top and y_offset < area_rect.bottom:
+                    surface.blit(render_text(font, wline, True, BABY_BLUE), (area_rect.left, y_offset))
+                y_offset += line_height
+        else:
+            y_offset += entry_height
+
+def spill_conversation():
+    # Drop whole You/Guide turns from the front until the history fits.
+    global llm_conversation_base
+    excess = len(llm_conversation) - LLM_HISTORY_MAX_ENTRIES
+    if excess <= 0:
+        return
+    excess += excess % 2
+    del llm_conversation[:excess]
+    del conversation_layout[:excess]
+    llm_conversation_base += excess
+
+# --- GUIDE CHAT SESSION ---
+# Earlier turns of the open Guide popup are sent with every question so the
+# model can follow up on them. The history is counted in estimated tokens;
+# once it passes CHAT_HISTORY_TOKENS the oldest turns are dropped until it is
+# under CHAT_TRIM_TOKENS. Trimming well below the limit means the message
+# prefix, and with it the server's cached context, changes only now and then.
+CHAT_HISTORY_TOKENS = 600 if args.memory_budget else 1200
+CHAT_TRIM_TOKENS = 300 if args.memory_budget else 600
+CHAT_CHARS_PER_TOKEN = 4   # Rough average for English text
+chat_lock = threading.Lock()
+chat_session = None        # llm_session the history belongs to
+chat_history = []          # {"role", "content"} messages, oldest first
+
+def estimate_tokens(text):
+    return len(text) // CHAT_CHARS_PER_TOKEN + 1
+
+def chat_history_for(session):
+    global chat_session
+    with chat_lock:
+        if chat_session != session:
+            chat_session = session
+            del chat_history[:]
+        return list(chat_history)
+
+def chat_add_turn(session, question, answer):
+    with chat_lock:
+        if chat_session != session:
+            return
+        chat_history.append({"role": "user", "content": question})
+        chat_history.append({"role": "assistant", "content": answer})
+        total = sum(estimate_tokens(m["content"]) for m in chat_history)
+        if total > CHAT_HISTORY_TOKENS:
+            while chat_history and total > CHAT_TRIM_TOKENS:
+                total -= sum(estimate_tokens(m["content"]) for m in chat_history[:2])
+                del chat_history[:2]
+
+def chat_reset():
+    global chat_session
+    with chat_lock:
+        chat_session = None
+        del chat_history[:]
+
+# --- ANSWER BUDGET ---
+# The system prompt asks for one or two sentences, but the model often goes
+# on for a paragraph nobody reads. Generation stops as soon as the answer has
+# ANSWER_MAX_SENTENCES sentences, ANSWER_MAX_TOKENS tokens (also sent to
+# Ollama as num_predict) or has been going for ANSWER_MAX_SECONDS. Stopping
+# closes the connection or kills the CLI process, so the model stops too. An
+# answer cut off mid-sentence is trimmed back to its last full sentence.
+ANSWER_MAX_SENTENCES = 2
+ANSWER_MAX_TOKENS = 96
+ANSWER_MAX_SECONDS = 20.0
+# A sentence ends at . ! or ? (and any closing quotes or brackets) followed
+# by a space; initials and a few common titles do not count.
+SENTENCE_END = re.compile(r"(?<!\b[A-Z])(?<!\bMr)(?<!\bMs)(?<!\bDr)(?<!\bSt)(?<!\bMrs)(?<!\be\.g)(?<!\bi\.e)"
+                          r"[.!?]+[\"')\]]*(?=\s)")
+
+def sentence_boundary(text, count):
+    # Index just past the end of the count-th sentence, or None.
+    for i, match in enumerate(SENTENCE_END.finditer(text)):
+        if i + 1 == count:
+            return match.end()
+    return None
+
+def trim_answer(text):
+    # Cuts an unfinished last sentence; a single unfinished sentence keeps
+    # its whole words and gets an ellipsis.
+    ends = [match.end() for match in SENTENCE_END.finditer(text + " ")]
+    if ends:
+        return text[:ends[-1]].rstrip()
+    words = text.rstrip()
+    cut = words.rfind(" ")
+    if cut > 0:
+        words = words[:cut]
+    return words.rstrip(",;:- ") + "..." if words else ""
+
+def llm_stop_for_budget(request):
+    # Like llm_cancel, but the answer so far is kept.
+    with llm_queue_cond:
+        request["budget_expired"] = True
+        resource = request.get("resource")
+    if resource is not None:
+        llm_abort_resource(resource)
+
+def llm_generate_within_budget(messages, request):
+    # llm_generate, stopped once the answer budget is used up. The reason
+    # ("sentences", "tokens" or "time") is left in request["stopped"]; after
+    # "tokens" or "time" the caller should trim_answer() what it got.
+    timer = threading.Timer(ANSWER_MAX_SECONDS, llm_stop_for_budget, (request,))
+    timer.daemon = True
+    timer.start()
+    start = time.perf_counter()
+    shown = ""
+    tokens = 0
+    stream = llm_generate(messages, request)
+    try:
+        for piece in stream:
+            # The CLI hands over whatever output is ready, not single tokens.
+            tokens += max(1, len(piece) // CHAT_CHARS_PER_TOKEN) if request.get("backend") == "cli" else 1
+            candidate = shown + piece
+            end = sentence_boundary(candidate, ANSWER_MAX_SENTENCES)
+            if end is not None:
+                request["stopped"] = "sentences"
+                piece = candidate[len(shown):max(end, len(shown))]
+            elif tokens > ANSWER_MAX_TOKENS:
+                # Ollama stops by itself at num_predict; this catches the
+                # CLI and servers that ignore it.
+                request["stopped"] = "tokens"
+            elif request.get("budget_expired") or time.perf_counter() - start >= ANSWER_MAX_SECONDS:
+                request["stopped"] = "time"
+            if piece:
+                shown += piece
+                yield piece
+            if request.get("stopped"):
+                return
+    except Exception:
+        # The timer shut the connection down under a stalled answer.
+        if not request.get("budget_expired") or request["cancel"].is_set():
+            raise
+        request["stopped"] = "time"
+        return
+    finally:
+        timer.cancel()
+        stream.close()
+    if request.get("budget_expired") and not request["cancel"].is_set():
+        request["stopped"] = "time"
+    elif (request.get("server_stats") or {}).get("done_reason") == "length":
+        request["stopped"] = "tokens"   # Ollama itself stopped at num_predict
+
+# --- STREAMING LLM FUNCTION USING Ollama with tinyllama ---
+def llm_thread_stream(request):
+    session, response_index = request["session"], request["response_index"]
+    history = chat_history_for(session)
+    # Cached answers are only valid for a question asked without history.
+    cached = llm_cache_get(request["query"]) if not history else None
+    if cached is not None:
+        llm_stream_push(session, response_index, cached)
+        chat_add_turn(session, request["query"], cached)
+        llm_metrics_record(request, "cached")
+        return
+    request["history_messages"] = len(history)
+    answer = []
+    stream = llm_generate_within_budget(build_messages(request["query"], history), request)
+    try:
+        for piece in stream:
+            if request["cancel"].is_set():
+                break
+            if not answer:
+                record_first_token(request["asked_at"])
+            llm_metrics_token(request)
+            answer.append(piece)
+            llm_stream_push(session, response_index, piece)
     except Exception as e:
-        llm_conversation[response_index] = "Guide: LLM Error: " + str(e)
+        if not request["cancel"].is_set():
+            llm_metrics_record(request, "error", e)
+            llm_stream_push(session, response_index, "Guide: LLM Error: " + str(e), replace=True)
+            return
+    finally:
+        stream.close()
+    if request["cancel"].is_set():
+        llm_metrics_record(request, "cancelled")
+        llm_stream_push(session, response_index, " [interrupted]")
+        return
+    text = "".join(answer)
+    if request.get("stopped") in ("tokens", "time"):
+        text = trim_answer(text)
+        llm_stream_push(session, response_index, "Guide: " + (text or "(no answer in time)"), replace=True)
+    llm_metrics_record(request, "ok")
+    chat_add_turn(session, request["query"], text)
+    if not history and text:
+        llm_cache_put(request["query"], text)
 
-# --- SPLASH SCREEN LOADING ANIMATION ---
-original_splash = pygame.image.load("assets/images/dont-panic.png").convert_alpha()
-splash_img = pygame.transform.smoothscale(original_splash,
-                 (original_splash.get_width() // 2, original_splash.get_height() // 2))
-splash_rect = splash_img.get_rect(center=(WIDTH // 2, HEIGHT // 2))
-splash_duration = 3000  # 3 seconds
-splash_start = pygame.time.get_ticks()
+# --- LLM REQUEST SCHEDULER ---
+# One worker thread answers questions one at a time from a short queue. What
+# happens to a question asked while another is being answered depends on
+# LLM_BUSY_POLICY: "queue" waits its turn (up to LLM_QUEUE_SIZE waiting),
+# "replace" stops the current answer and drops anything waiting, "reject"
+# turns it away. Cancelling shuts down the HTTP connection or kills the CLI
+# process, so Ollama stops generating straight away.
+LLM_BUSY_POLICY = "replace"
+LLM_QUEUE_SIZE = 2
+llm_queue = deque()
+llm_queue_cond = threading.Condition()
+llm_active_request = None
 
-while pygame.time.get_ticks() - splash_start < splash_duration:
-    for event in pygame.event.get():
-        if event.type == pygame.QUIT:
-            pygame.quit()
-            sys.exit()
-    screen.fill(SALMON)
-    screen.blit(splash_img, splash_rect)
-    pygame.display.flip()
-    clock.tick(60)
-# --- END SPLASH SCREEN ---
+def llm_attach(request, resource):
+    # Called by a backend once it holds a connection or process that
+    # llm_cancel should tear down.
+    if request is None:
+        return
+    with llm_queue_cond:
+        request["resource"] = resource
+        cancelled = request["cancel"].is_set()
+    if cancelled:
+        llm_abort_resource(resource)
+
+def llm_stopping(request):
+    # True once llm_cancel or the answer budget has shut the request's
+    # connection or process down.
+    return request is not None and (request["cancel"].is_set() or request.get("budget_expired", False))
+
+def llm_abort_resource(resource):
+    try:
+        if isinstance(resource, subprocess.Popen):
+            if resource.poll() is None:
+                resource.kill()
+        elif resource.sock is not None:
+            resource.sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+def llm_cancel(request):
+    with llm_queue_cond:
+        request["cancel"].set()
+        resource = request.get("resource")
+    if resource is not None:
+        llm_abort_resource(resource)
+
+def llm_cancel_all():
+    with llm_queue_cond:
+        dropped = list(llm_queue)
+        llm_queue.clear()
+        active = llm_active_request
+    for request in dropped:
+        request["cancel"].set()
+        llm_metrics_record(request, "skipped")
+    if active is not None:
+        llm_cancel(active)
+    return dropped
+
+def llm_skip_all():
+    # What "replace" does to the answers in progress and waiting.
+    for dropped in llm_cancel_all():
+        llm_stream_push(dropped["session"], dropped["response_index"], "Guide: (skipped)", replace=True)
+
+def llm_submit(query, response_index, session):
+    # Returns False if the question was turned away.
+    request = {"query": query, "response_index": response_index, "session": session,
+               "asked_at": time.perf_counter(), "cancel": threading.Event(), "resource": None,
+               "backend": LLM_BACKEND}
+    if LLM_BUSY_POLICY == "replace":
+        llm_skip_all()
+    with llm_queue_cond:
+        busy = llm_active_request is not None or llm_queue
+        rejected = (LLM_BUSY_POLICY == "reject" and busy) or len(llm_queue) >= LLM_QUEUE_SIZE
+        if not rejected:
+            llm_queue.append(request)
+            llm_queue_cond.notify()
+    if rejected:
+        llm_metrics_record(request, "rejected")
+    return not rejected
+
+def llm_busy():
+    with llm_queue_cond:
+        return llm_active_request is not None or bool(llm_queue)
+
+def llm_worker():
+    global llm_active_request
+    while True:
+        with llm_queue_cond:
+            while not llm_queue:
+                llm_queue_cond.wait()
+            request = llm_queue.popleft()
+            llm_active_request = request
+        request["started_at"] = time.perf_counter()
+        if not request["cancel"].is_set():
+            llm_thread_stream(request)
+        with llm_queue_cond:
+            llm_active_request = None
+
+threading.Thread(target=llm_worker, daemon=True).start()
+
+# --- LLM TELEMETRY ---
+# Each question the Guide handles leaves one record: how long it waited in
+# the queue, the time from starting it to the first token, how many tokens
+# followed and how fast (the server's own eval counts when it sends them,
+# otherwise the streamed chunks), the total time, and how it ended: ok,
+# cached, error, cancelled, skipped (dropped from the queue) or rejected.
+# Answers cut short by the answer budget also note why and, from the token
+# rate, how much generation time that saved at most (the model would have
+# stopped by itself at ANSWER_MAX_TOKENS).
+# Records are appended to LLM_METRICS_LOG as JSON lines; the last
+# LLM_METRICS_WINDOW feed the rolling summary in the F3 overlay, on exit and
+# in --bench results.
+LLM_METRICS_LOG = None if args.bench_scenario else os.path.join("cache", "llm_metrics.jsonl")
+LLM_METRICS_LOG_MAX_BYTES = 1024 * 1024   # The log is moved to .1 past this
+LLM_METRICS_WINDOW = 20 if args.memory_budget else 100
+llm_metrics = deque(maxlen=LLM_METRICS_WINDOW)
+llm_metrics_lock = threading.Lock()
+
+def llm_metrics_token(request):
+    now = time.perf_counter()
+    if "first_token_at" not in request:
+        request["first_token_at"] = now
+    request["last_token_at"] = now
+    request["tokens"] = request.get("tokens", 0) + 1
+
+def llm_metrics_record(request, outcome, error=None):
+    now = time.perf_counter()
+    asked, started, first = request["asked_at"], request.get("started_at"), request.get("first_token_at")
+    record = {
+        "time": round(time.time(), 3),
+        "outcome": outcome,
+        "backend": request.get("backend"),
+        "history_messages": request.get("history_messages", 0),
+        "queue_wait_ms": round((started - asked) * 1000.0, 1) if started else None,
+        "ttft_ms": round((first - started) * 1000.0, 1) if first and started else None,
+        "total_ms": round((now - asked) * 1000.0, 1),
+        "tokens": request.get("tokens", 0),
+        "tokens_per_s": None,
+    }
+    server = request.get("server_stats") or {}
+    if server.get("eval_count") and server.get("eval_duration"):
+        record["tokens_per_s"] = round(server["eval_count"] / (server["eval_duration"] / 1e9), 2)
+    elif record["tokens"] > 1 and request["last_token_at"] > first:
+        record["tokens_per_s"] = round((record["tokens"] - 1) / (request["last_token_at"] - first), 2)
+    if request.get("stopped"):
+        record["stopped"] = request["stopped"]
+        if record["tokens_per_s"]:
+            remaining = max(0, ANSWER_MAX_TOKENS - record["tokens"])
+            record["saved_ms"] = round(remaining / record["tokens_per_s"] * 1000.0, 1)
+    if server:
+        record["server"] = server
+    if error is not None:
+        record["error"] = "%s: %s" % (type(error).__name__, error)
+    with llm_metrics_lock:
+        llm_metrics.append(record)
+        if LLM_METRICS_LOG:
+            try:
+                os.makedirs(os.path.dirname(LLM_METRICS_LOG), exist_ok=True)
+                if os.path.exists(LLM_METRICS_LOG) and os.path.getsize(LLM_METRICS_LOG) > LLM_METRICS_LOG_MAX_BYTES:
+                    os.replace(LLM_METRICS_LOG, LLM_METRICS_LOG + ".1")
+                with open(LLM_METRICS_LOG, "a") as f:
+                    f.write(json.dumps(record) + "\n")
+            except OSError:
+                pass
+
+def llm_metrics_summary():
+    with llm_metrics_lock:
+        records = list(llm_metrics)
+    if not records:
+        return None
+    outcomes = {}
+    for record in records:
+        outcomes[record["outcome"]] = outcomes.get(record["outcome"], 0) + 1
+    ttft = [record["ttft_ms"] for record in records if record["ttft_ms"] is not None]
+    queue = [record["queue_wait_ms"] for record in records if record["queue_wait_ms"] is not None]
+    rates = [record["tokens_per_s"] for record in records if record["tokens_per_s"]]
+    stopped = [record for record in records if record.get("stopped")]
+    return {
+        "requests": len(records),
+        "outcomes": outcomes,
+        "ttft_p50_ms": percentile(ttft, 50),
+        "ttft_p95_ms": percentile(ttft, 95),
+        "queue_p50_ms": percentile(queue, 50),
+        "queue_p95_ms": percentile(queue, 95),
+        "tokens_per_s": round(sum(rates) / len(rates), 1) if rates else None,
+        "stopped_early": len(stopped),
+        "saved_ms": round(sum(record.get("saved_ms") or 0.0 for record in stopped), 1),
+    }
+
+def llm_metrics_report():
+    summary = llm_metrics_summary()
+    return format_llm_summary(summary) if summary else "LLM: no questions asked"
+
+# --- FRAME PACING ---
+# Animations advance by elapsed time (speeds are in pixels per second), so a
+# slow frame no longer slows them down. While nothing is animating or
+# streaming, the loop sleeps in pygame.event.wait() instead of ticking at
+# ACTIVE_FPS, and any input brings it straight back to full rate.
+ACTIVE_FPS = 30
+IDLE_WAIT_MS = 1000       # Longest sleep between idle frames
+IDLE_GRACE_MS = 500       # Stay at full rate this long after the last input
+MAX_FRAME_DT = 0.1        # Clamp for the animation step after a stall
+pacing_state = "active"   # "active" or "idle"
+frame_dt = 0.0            # Seconds covered by the current frame
+last_input_ticks = 0
+
+def step_towards(value, target, step):
+    if value < target:
+        return min(value + step, target)
+    return max(value - step, target)
+
+def get_pacing_state():
+    return {"state": pacing_state, "fps": clock.get_fps(), "frame_dt": frame_dt}
 
 # --- MAIN LIST ANIMATION SETUP ---
-current_button_index = 0
+main_list_elapsed = 0.0
 main_list_animation_done = False
-BUTTON_GROWTH_SPEED = 12
+BUTTON_GROWTH_SPEED = 360  # pixels per second; the buttons grow one after another
 for button in buttons:
     button["rect"].width = 0
 # --- END MAIN LIST ANIMATION SETUP ---
@@ -191,9 +1609,9 @@ intro_bar_width = 0
 INTRO_BAR_MAX_WIDTH = 300
 stack_bars_width = 0
 STACK_BARS_MAX_WIDTH = 100
-BAR_GROWTH_SPEED = 10
-RETRACT_SPEED = 10
-BAR_RETRACT_SPEED = 10
+BAR_GROWTH_SPEED = 300   # pixels per second
+RETRACT_SPEED = 300
+BAR_RETRACT_SPEED = 300
 show_text = False
 
 # Popup related variables (for file popup or LLM guide)
@@ -201,18 +1619,309 @@ popup_active = False
 popup_text = ""
 popup_width = 700
 popup_height = 500
-SLIDE_SPEED = 10
+SLIDE_SPEED = 300        # pixels per second
+SLIDE_DISTANCE = 500     # How far the main list slides off-screen behind a popup
+slide_offset = 0.0
 popup_scroll_offset = 0
 
+# --- DIRTY RECTANGLE RENDERING ---
+# Each frame only the regions marked as changed are redrawn and pushed to the
+# display; an idle screen costs no drawing at all. Set DIRTY_RECTS = False to
+# repaint and flip the whole screen every frame instead.
+DIRTY_RECTS = True
+dirty_rects = []                 # Regions to redraw on the next frame
+frame_clip = screen.get_rect()   # Area the current frame draws into
+
+def mark_dirty(rect=None):
+    dirty_rects.append(pygame.Rect(rect) if rect is not None else screen.get_rect())
+
+def popup_bounds():
+    # The popup including its border.
+    return ui_for(screen.get_size())["popup"]["rect"].inflate(12, 12)
+
+def input_box_bounds():
+    return ui_for(screen.get_size())["input_box"]["rect"]
+
+def expansion_bounds(button):
+    # Everything the intro bar and the label stack next to a button can cover.
+    rect = button["rect"]
+    return pygame.Rect(rect.right, rect.y - 6 * rect.height, INTRO_BAR_MAX_WIDTH, 7 * rect.height)
+
+# --- WIDGET TREE ---
+# The screen is a tree of widgets: plain dicts with a name, a rect and their
+# children. layout_ui() lays the tree out once per screen size; the label
+# stack and the search results get new children only when the active button
+# or the result list changes. Widgets with an "action" can be touched, and
+# for each screen mode (menu, page, guide, search) those are bucketed into
+# horizontal bands so a tap only looks at the few widgets in its band.
+HIT_BAND_HEIGHT = 40
+MODE_TARGETS = {
+    "menu": ["quit", "main_menu", "label_stack", "guide_button", "search_button"],
+    "page": ["quit", "close"],
+    "guide": ["quit", "close", "scroll_up", "scroll_down"],
+    "search": ["quit", "close", "search_results"],
+}
+ui_layouts = {}   # screen size -> {widget name: widget}
+ui = {}           # Layout of the current screen
+hit_indexes = {}  # mode -> {band: [widget, ...]} for the current layout
+
+def widget(layout, name, rect, children=(), **extra):
+    # A Rect passed in is kept, not copied, so widgets can share live rects.
+    rect = rect if isinstance(rect, pygame.Rect) else pygame.Rect(rect)
+    node = {"name": name, "rect": rect, "children": list(children)}
+    node.update(extra)
+    layout[name] = node
+    return node
+
+def layout_ui(width, height):
+    layout = {}
+    popup_rect = pygame.Rect((width - popup_width) // 2, (height - popup_height) // 2, popup_width, popup_height)
+    margin = 20
+    input_box_height = 40
+    input_rect = pygame.Rect(popup_rect.left + margin, popup_rect.bottom - margin - input_box_height,
+                             popup_rect.width - 2 * margin, input_box_height)
+    # Guide mode: conversation on the left, then a narrow scrollbar and the
+    # arrow buttons.
+    conversation_rect = pygame.Rect(
+        popup_rect.left + margin,
+        popup_rect.top + margin,
+        popup_rect.width - 2 * margin - (SCROLLBAR_WIDTH + SCROLL_BTN_WIDTH + 10),
+        popup_rect.height - 2 * margin - input_box_height - 10
+    )
+    arrows_x = conversation_rect.right + SCROLLBAR_WIDTH + 5
+    # Page mode: text left of a scrollbar that starts below the close button.
+    page_visible = popup_rect.height - 2 * PAGE_MARGIN - PAGE_TRACK_TOP_OFFSET
+    guide_rect = pygame.Rect(MAIN_BUTTON_X, height - (bottom_margin / 1.75) - button_height,
+                             MAIN_BUTTON_WIDTH - 250, button_height)
+    widget(layout, "root", (0, 0, width, height), [
+        widget(layout, "main_menu", (MAIN_BUTTON_X, top_button_y, MAIN_BUTTON_WIDTH, len(buttons) * button_height),
+               # The main buttons keep their own rects, which the animations move.
+               [widget(layout, "menu:" + b["text"], b["rect"], action="main_button", button=b) for b in buttons]),
+        widget(layout, "label_stack", (0, 0, 0, 0), source=None),
+        widget(layout, "guide_button", guide_rect, action="guide"),
+        # SEARCH sits right of THE GUIDE, same size.
+        widget(layout, "search_button", guide_rect.move(guide_rect.width + 10, 0), action="search"),
+        widget(layout, "popup", popup_rect, [
+            widget(layout, "close", (popup_rect.right - 40, popup_rect.top + 10, 30, 30), action="close"),
+            widget(layout, "conversation", conversation_rect),
+            widget(layout, "guide_track", (conversation_rect.right, conversation_rect.top,
+                                           SCROLLBAR_WIDTH, conversation_rect.height)),
+            widget(layout, "scroll_up", (arrows_x, conversation_rect.top + 60, SCROLL_BTN_WIDTH, SCROLL_BTN_HEIGHT),
+                   action="scroll_up"),
+            widget(layout, "scroll_down", (arrows_x, conversation_rect.bottom - SCROLL_BTN_HEIGHT,
+                                           SCROLL_BTN_WIDTH, SCROLL_BTN_HEIGHT), action="scroll_down"),
+            widget(layout, "search_results", (popup_rect.left + margin, popup_rect.top + margin + 30, SEARCH_RESULT_WIDTH,
+                                              input_rect.top - popup_rect.top - 2 * margin - 30), source=None),
+            widget(layout, "page_text", (popup_rect.left, popup_rect.top,
+                                         popup_rect.width - (PAGE_SCROLLBAR_WIDTH + 5), popup_rect.height)),
+            widget(layout, "page_track", (popup_rect.right - PAGE_SCROLLBAR_WIDTH - 5,
+                                          popup_rect.top + PAGE_MARGIN + PAGE_TRACK_TOP_OFFSET,
+                                          PAGE_SCROLLBAR_WIDTH, page_visible)),
+            widget(layout, "input_box", input_rect),
+        ]),
+        widget(layout, "quit", QUIT_BUTTON_RECT, action="quit"),
+    ])
+    return layout
+
+def ui_for(size):
+    layout = ui_layouts.get(size)
+    if layout is None:
+        layout = ui_layouts[size] = layout_ui(*size)
+    return layout
+
+def layout_label_stack(button):
+    stack = ui["label_stack"]
+    if button is None:
+        stack["children"] = []
+        stack["rect"] = pygame.Rect(0, 0, 0, 0)
+        return
+    rect = button["rect"]
+    labels = ["THE GUIDE"] if button["text"] == "HITCHHIKING" else ["WHO", "WHAT", "WHY", "WHERE", "WHEN", "HOW"]
+    intro_right = rect.right + INTRO_BAR_MAX_WIDTH
+    children = []
+    for i, label in enumerate(labels):
+        slot = pygame.Rect(intro_right - STACK_BARS_MAX_WIDTH, rect.y - (len(labels) - i) * rect.height,
+                           STACK_BARS_MAX_WIDTH, rect.height)
+        # Only the label text is touchable, as it always was.
+        text_rect = render_text(get_font("anim"), label, True, WHITE).get_rect(midright=(slot.right - 10, slot.centery))
+        children.append({"name": "label:" + label, "rect": text_rect, "children": [], "action": "label",
+                         "label": label, "slot": slot, "color": list_colors[i]})
+    stack["children"] = children
+    stack["rect"] = children[0]["slot"].unionall([child["slot"] for child in children])
+
+def layout_search_rows(results):
+    area = ui["search_results"]
+    row_height = 2 * get_font("popup").get_height() + 15
+    children = []
+    y = area["rect"].top
+    for result in results:
+        if y + row_height > area["rect"].bottom:
+            break
+        children.append({"name": "result:" + result["key"], "rect": pygame.Rect(area["rect"].left, y, area["rect"].width, row_height - 5),
+                         "children": [], "action": "result", "result": result})
+        y += row_height
+    area["children"] = children
+
+def ui_sync():
+    # Re-lay out whatever changed since the last call; cheap when nothing did.
+    global ui
+    layout = ui_for(screen.get_size())
+    if layout is not ui:
+        ui = layout
+        hit_indexes.clear()
+    source = (active_button["text"], active_button["rect"].right, active_button["rect"].y) if active_button else None
+    if ui["label_stack"]["source"] != source:
+        ui["label_stack"]["source"] = source
+        layout_label_stack(active_button)
+        hit_indexes.pop("menu", None)
+    if ui["search_results"]["source"] is not search_results:
+        ui["search_results"]["source"] = search_results
+        layout_search_rows(search_results)
+        hit_indexes.pop("search", None)
+
+def ui_mode():
+    if not popup_active:
+        return "menu"
+    if search_mode:
+        return "search"
+    return "guide" if guide_mode else "page"
+
+def touch_targets(node):
+    if "action" in node:
+        yield node
+    for child in node["children"]:
+        yield from touch_targets(child)
+
+def hit_test(pos):
+    # The touchable widget under pos, or None. Earlier MODE_TARGETS win.
+    ui_sync()
+    mode = ui_mode()
+    index = hit_indexes.get(mode)
+    if index is None:
+        index = hit_indexes[mode] = {}
+        for name in MODE_TARGETS[mode]:
+            for node in touch_targets(ui[name]):
+                # Main buttons grow and slide sideways but never move up or down.
+                top, bottom = node["rect"].top, node["rect"].bottom
+                for band in range(top // HIT_BAND_HEIGHT, (bottom - 1) // HIT_BAND_HEIGHT + 1):
+                    index.setdefault(band, []).append(node)
+    for node in index.get(pos[1] // HIT_BAND_HEIGHT, ()):
+        if node["rect"].collidepoint(pos):
+            return node
+    return None
+
+# --- STATIC CHROME LAYER ---
+# What only changes with the screen size is drawn once per resolution: the
+# background with the purple bar and THE GUIDE / SEARCH buttons, the popup
+# frame with its close button, and QUIT. Rounded bars are put together from
+# two cached end caps and a filled middle, so a bar growing by a few pixels
+# costs two blits and a fill, and a full-width main button is a single blit.
+BACKGROUND_COLOR = (250, 240, 120)
+PURPLE_BAR_HEIGHT = 48
+CHROME_KEY = (255, 0, 255)  # Transparent color of chrome sprites
+chrome_layers = {}          # screen size -> {"background", "popup_frame", "quit"}
+bar_caps = {}               # (color, height, radius) -> (left cap, right cap)
+button_sprites = {}         # (text, color, size) -> full-width main button
+
+def keyed_surface(size):
+    surf = pygame.Surface(size).convert()
+    surf.fill(CHROME_KEY)
+    surf.set_colorkey(CHROME_KEY)
+    return surf
+
+def blit_bar(surface, color, rect, border_radius=15):
+    # Same pixels as pygame.draw.rect(surface, color, rect, border_radius=...).
+    rect = pygame.Rect(rect)
+    radius = min(border_radius, rect.height // 2)
+    if rect.width < 2 * radius + 1:
+        pygame.draw.rect(surface, color, rect, border_radius=border_radius)
+        return
+    key = (tuple(color), rect.height, radius)
+    caps = bar_caps.get(key)
+    if caps is None:
+        sprite = keyed_surface((2 * radius + 1, rect.height))
+        pygame.draw.rect(sprite, color, sprite.get_rect(), border_radius=border_radius)
+        caps = (sprite.subsurface((0, 0, radius, rect.height)).copy(),
+                sprite.subsurface((radius + 1, 0, radius, rect.height)).copy())
+        for cap in caps:
+            cap.set_colorkey(CHROME_KEY)
+        bar_caps[key] = caps
+    surface.blit(caps[0], rect.topleft)
+    # fill() does not clip a rect that starts off the surface, so clip it here.
+    middle = pygame.Rect(rect.x + radius, rect.y, rect.width - 2 * radius, rect.height)
+    surface.fill(color, middle.clip(surface.get_rect()))
+    surface.blit(caps[1], (rect.right - radius, rect.y))
+
+def blit_labelled_bar(surface, color, rect, text):
+    blit_bar(surface, color, rect)
+    text_surf = render_text(get_font("main"), text, True, WHITE)
+    surface.blit(text_surf, text_surf.get_rect(midright=(rect.right - 10, rect.centery)))
+
+def chrome_for(size):
+    layers = chrome_layers.get(size)
+    if layers is not None:
+        return layers
+    width, height = size
+    layout = ui_for(size)
+    background = pygame.Surface(size).convert()
+    background.fill(BACKGROUND_COLOR)
+    pygame.draw.rect(background, PURPLE, (0, height - PURPLE_BAR_HEIGHT, width, PURPLE_BAR_HEIGHT))
+    blit_labelled_bar(background, list_colors[5], layout["guide_button"]["rect"], "THE GUIDE")
+    blit_labelled_bar(background, list_colors[0], layout["search_button"]["rect"], "SEARCH")
+
+    outer_rect = layout["popup"]["rect"].inflate(12, 12)
+    popup_frame = keyed_surface(outer_rect.size)
+    inner_rect = layout["popup"]["rect"].move(-outer_rect.x, -outer_rect.y)
+    pygame.draw.rect(popup_frame, (80, 80, 80), popup_frame.get_rect(), border_radius=15)
+    pygame.draw.rect(popup_frame, (200, 200, 200), popup_frame.get_rect(), 2, border_radius=15)
+    pygame.draw.rect(popup_frame, BLACK, inner_rect, border_radius=10)
+    close_rect = layout["close"]["rect"].move(-outer_rect.x, -outer_rect.y)
+    pygame.draw.rect(popup_frame, GREY, close_rect)
+
+    quit_button = keyed_surface(QUIT_BUTTON_RECT.size)
+    pygame.draw.rect(quit_button, GREY, quit_button.get_rect(), border_radius=5)
+    pygame.draw.rect(quit_button, WHITE, quit_button.get_rect(), 2, border_radius=5)
+    quit_text = render_text(get_font("main"), "QUIT", True, WHITE)
+    quit_button.blit(quit_text, quit_text.get_rect(center=quit_button.get_rect().center))
+
+    layers = {"background": background, "popup_frame": popup_frame, "popup_pos": outer_rect.topleft,
+              "quit": quit_button, "close_rect": close_rect, "close_label": False}
+    if not args.memory_budget:
+        popup_frame_for(layers)
+    chrome_layers[size] = layers
+    return layers
+
+def popup_frame_for(layers):
+    # The "X" needs the popup font, which --memory-budget mode only opens
+    # once a popup is shown.
+    if not layers["close_label"]:
+        x_text = render_text(get_font("close"), "X", True, WHITE)
+        layers["popup_frame"].blit(x_text, x_text.get_rect(center=layers["close_rect"].center))
+        layers["close_label"] = True
+    return layers["popup_frame"]
+
 def draw_button(surface, button):
-    pygame.draw.rect(surface, button["color"], button["rect"], border_radius=15)
-    text_surf = font_main.render(button["text"], True, WHITE)
-    text_rect = text_surf.get_rect(midright=(button["rect"].right - 10, button["rect"].centery))
-    surface.blit(text_surf, text_rect)
+    rect = button["rect"]
+    if rect.width != MAIN_BUTTON_WIDTH:
+        blit_labelled_bar(surface, button["color"], rect, button["text"])
+        return
+    key = (button["text"], tuple(button["color"]), rect.size)
+    sprite = button_sprites.get(key)
+    if sprite is None:
+        sprite = keyed_surface(rect.size)
+        blit_labelled_bar(sprite, button["color"], sprite.get_rect(), button["text"])
+        button_sprites[key] = sprite
+    surface.blit(sprite, rect.topleft)
 
 def load_page_text(main_category, vertical_label):
     folder = main_to_folder.get(main_category, main_category.lower().replace(" ", "_"))
-    file_path = os.path.join("assets", "pages", folder, f"{vertical_label.lower()}.txt")
+    preloaded = preloaded_pages.get(folder + "/" + vertical_label.lower())
+    if preloaded is not None:
+        return preloaded
+    if content_pack is not None:
+        text = content_pack_text(content_pack, folder + "/" + vertical_label.lower())
+        return text if text is not None else "Content not found."
+    file_path = os.path.join(PAGES_DIR, folder, f"{vertical_label.lower()}.txt")
     if os.path.exists(file_path):
         try:
             with open(file_path, "r") as f:
@@ -221,40 +1930,630 @@ def load_page_text(main_category, vertical_label):
             return "Error loading content."
     return "Content not found."
 
+# --- PAGE LAYOUT CACHE ---
+# A page is wrapped and rendered once when it is opened. Scrolling the popup
+# then only blits the visible slice of the pre-rendered tiles. In
+# --memory-budget mode tiles are smaller, rendered when they scroll into view
+# and dropped again once they are out of it.
+PAGE_MARGIN = 20
+PAGE_SCROLLBAR_WIDTH = 10
+PAGE_TRACK_TOP_OFFSET = 30
+PAGE_TILE_HEIGHT = 512 if args.memory_budget else 2048   # Very long pages are split into tiles no taller than this
+page_layout = None        # Layout of the page shown in the file popup (None when closed)
+
+def layout_page(text, font, max_width, surface_width):
+    wrapped_lines = []
+    for line in text.splitlines():
+        wrapped_lines.extend(wrap_text(line, font, max_width))
+    line_height = font.get_height() + 5
+    lines_per_tile = max(1, PAGE_TILE_HEIGHT // line_height)
+    chunks = [wrapped_lines[start:start + lines_per_tile]
+              for start in range(0, len(wrapped_lines), lines_per_tile)]
+    layout = {
+        "chunks": chunks,
+        "tiles": [None] * len(chunks),
+        "font": font,
+        "surface_width": surface_width,
+        "line_height": line_height,
+        "tile_height": lines_per_tile * line_height,
+        "height": line_height * len(wrapped_lines),
+    }
+    if not args.memory_budget:
+        for i in range(len(chunks)):
+            render_page_tile(layout, i)
+    return layout
+
+def render_page_tile(layout, i):
+    chunk = layout["chunks"][i]
+    line_height = layout["line_height"]
+    tile = pygame.Surface((layout["surface_width"], len(chunk) * line_height)).convert()
+    # The popup background is black, so text rendered onto black and keyed
+    # out looks the same as text rendered straight onto the popup.
+    tile.fill(BLACK)
+    for j, line in enumerate(chunk):
+        tile.blit(layout["font"].render(line, True, BABY_BLUE), (0, j * line_height))
+    tile.set_colorkey(BLACK, pygame.RLEACCEL)
+    layout["tiles"][i] = tile
+    return tile
+
+def page_tile_bytes(layout):
+    return sum(tile.get_width() * tile.get_height() * tile.get_bytesize()
+               for tile in layout["tiles"] if tile is not None)
+
+def open_page_layout(text):
+    effective_width = popup_width - 2 * PAGE_MARGIN - (PAGE_SCROLLBAR_WIDTH + 5)
+    surface_width = popup_width - (PAGE_SCROLLBAR_WIDTH + 5) - PAGE_MARGIN
+    return layout_page(text, get_font("popup"), effective_width, surface_width)
+
+if args.bench_wrap is not None:
+    # The widths a page and the Guide's conversation are wrapped to.
+    sys.exit(run_wrap_benchmark(args.bench_wrap, [
+        popup_width - 2 * PAGE_MARGIN - (PAGE_SCROLLBAR_WIDTH + 5),
+        popup_width - 2 * 20 - (SCROLLBAR_WIDTH + SCROLL_BTN_WIDTH + 10),
+    ]))
+
+def blit_page(surface, layout, x, y, clip_rect):
+    # (x, y) is where the first line of the page would land on screen.
+    for i, tile in enumerate(layout["tiles"]):
+        tile_top = y + i * layout["tile_height"]
+        top = max(clip_rect.top, tile_top)
+        bottom = min(clip_rect.bottom, tile_top + len(layout["chunks"][i]) * layout["line_height"])
+        if bottom <= top:
+            if args.memory_budget:
+                layout["tiles"][i] = None
+            continue
+        if tile is None:
+            tile = render_page_tile(layout, i)
+        area = pygame.Rect(0, top - tile_top, tile.get_width(), bottom - top)
+        surface.blit(tile, (x, top), area)
+
+# --- PAGE SEARCH ---
+# An inverted index over every page (term -> {page: count}) with a sorted term
+# list, so each query word is matched as a prefix with a bisect. The per-page
+# term counts are saved next to the pages and only pages whose mtime or size
+# changed are re-read when the index is refreshed.
+SEARCH_INDEX_PATH = os.path.join("assets", "pages.index.json")
+SEARCH_INDEX_VERSION = 1
+SEARCH_MAX_RESULTS = 8
+SEARCH_RESULT_WIDTH = popup_width - 2 * 20 - 40   # Leaves room for the close button
+search_mode = False       # True when the popup shows the search box and results
+search_query = ""
+search_results = []       # [{"key", "title", "snippet"}] for the current query
+search_results_index = None   # The search_index search_results came from
+folder_to_main = {folder: main for main, folder in main_to_folder.items()}
+
+def tokenize(text):
+    return re.findall(r"\w+", text.lower())
+
+def page_for_key(key):
+    folder, label = key.split("/", 1)
+    return folder_to_main.get(folder, folder), label.upper()
+
+def load_search_index():
+    try:
+        with open(SEARCH_INDEX_PATH, "r") as f:
+            saved = json.load(f)
+        docs = saved["docs"] if saved.get("version") == SEARCH_INDEX_VERSION else {}
+    except (OSError, ValueError, KeyError):
+        docs = {}
+    pages = scan_pages()
+    changed = False
+    for key in list(docs):
+        if key not in pages:
+            del docs[key]
+            changed = True
+    for key, path in pages.items():
+        signature = page_signature(path)
+        if key in docs and docs[key]["sig"] == signature:
+            continue
+        try:
+            with open(path, "r") as f:
+                text = f.read()
+        except OSError:
+            continue
+        category, label = page_for_key(key)
+        terms = {}
+        for term in tokenize(category + " " + label + " " + text):
+            terms[term] = terms.get(term, 0) + 1
+        docs[key] = {"sig": signature, "terms": terms, "snippet": " ".join(text.split())[:200]}
+        changed = True
+    if changed:
+        try:
+            with open(SEARCH_INDEX_PATH + ".tmp", "w") as f:
+                json.dump({"version": SEARCH_INDEX_VERSION, "docs": docs}, f)
+            os.replace(SEARCH_INDEX_PATH + ".tmp", SEARCH_INDEX_PATH)
+        except OSError:
+            pass
+    postings = {}
+    for key, doc in docs.items():
+        for term, count in doc["terms"].items():
+            postings.setdefault(term, {})[key] = count
+        if args.memory_budget:
+            # Searches only read the postings; the counts were only kept for saving.
+            del doc["terms"]
+    return {"docs": docs, "postings": postings, "terms": sorted(postings)}
+
+def search_pages(index, query):
+    # Every query word must match (as a prefix) somewhere in the page; exact
+    # word matches score higher than prefix matches.
+    tokens = tokenize(query)
+    if not tokens:
+        return []
+    terms = index["terms"]
+    scores = None
+    for token in tokens:
+        token_scores = {}
+        i = bisect.bisect_left(terms, token)
+        while i < len(terms) and terms[i].startswith(token):
+            postings = index["postings"][terms[i]]
+            weight = math.log(1 + len(index["docs"]) / len(postings))
+            if terms[i] != token:
+                weight *= 0.5
+            for key, count in postings.items():
+                token_scores[key] = max(token_scores.get(key, 0), count * weight)
+            i += 1
+        if scores is None:
+            scores = token_scores
+        else:
+            scores = {key: score + token_scores[key] for key, score in scores.items() if key in token_scores}
+        if not scores:
+            return []
+    return sorted(scores, key=lambda key: (-scores[key], key))[:SEARCH_MAX_RESULTS]
+
+def run_search(query, width):
+    results = []
+    if search_index is None:
+        return results   # Still being built after the splash
+    for key in search_pages(search_index, query):
+        category, label = page_for_key(key)
+        snippet_lines = wrap_text(search_index["docs"][key]["snippet"], get_font("popup"), width)
+        snippet = snippet_lines[0] if snippet_lines else ""
+        if len(snippet_lines) > 1:
+            snippet += "..."
+        results.append({"key": key, "title": category + " / " + label, "snippet": snippet})
+    return results
+
+search_index = None  # Built during the warm-up, from the same page files the app serves
+
+# --- CANNED ANSWERS ---
+# Questions close enough to one in the answer corpus are answered at once,
+# without waiting for the model. The corpus is the curated and pre-generated
+# answers in ANSWERS_PATH plus the opening of every page. Each entry is a
+# TF-IDF vector over its question and, with less weight, its answer; a new
+# question gets the answer of the most similar entry (cosine similarity) if
+# that reaches CANNED_MIN_SCORE and goes to the model otherwise. Like cached
+# answers, canned ones are only used for a question asked without history.
+ANSWERS_PATH = os.path.join("assets", "answers.json")
+CANNED_ENABLED = not (args.no_llm_cache or args.bench_scenario)
+CANNED_MIN_SCORE = 0.6        # Checked against bench/canned_probes.json with --check-canned
+CANNED_ANSWER_WEIGHT = 0.3   # Weight of an answer word relative to a question word
+CANNED_PAGE_CHARS = 300      # Page text quoted in an answer
+CANNED_STOPWORDS = frozenset(
+    "a about an and are be can do does for from how i in is it me my of on or please so "
+    "tell the there this to what when where which who why will with you your".split())
+answer_index = None  # Built during the splash screen
+canned_stats = {"hits": 0, "misses": 0, "lookup_ms": 0.0}
+
+def canned_terms(text):
+    return [term for term in tokenize(text) if term not in CANNED_STOPWORDS]
+
+def load_answer_entries():
+    try:
+        with open(ANSWERS_PATH, "r") as f:
+            return json.load(f)["answers"]
+    except (OSError, ValueError, KeyError):
+        return []
+
+def page_excerpt(text):
+    text = " ".join(text.split())
+    if len(text) <= CANNED_PAGE_CHARS:
+        return text
+    cut = text.rfind(". ", 0, CANNED_PAGE_CHARS)
+    return text[:cut + 1] if cut > 0 else text[:CANNED_PAGE_CHARS].rsplit(" ", 1)[0] + "..."
+
+def build_answer_index(entries, pages):
+    answers = []
+    texts = []   # (question, answer) each entry is matched on
+    for entry in entries:
+        answers.append(entry["answer"])
+        texts.append((entry["question"], entry["answer"]))
+    for key, text in sorted(pages.items()):
+        excerpt = page_excerpt(text)
+        if not excerpt:
+            continue
+        category, label = page_for_key(key)
+        answers.append("%s (See %s / %s.)" % (excerpt, category, label))
+        texts.append((category + " " + label, excerpt))
+    counts = []
+    for question, answer in texts:
+        tf = {}
+        for term in canned_terms(question):
+            tf[term] = tf.get(term, 0.0) + 1.0
+        for term in canned_terms(answer):
+            tf[term] = tf.get(term, 0.0) + CANNED_ANSWER_WEIGHT
+        counts.append(tf)
+    df = {}
+    for tf in counts:
+        for term in tf:
+            df[term] = df.get(term, 0) + 1
+    idf = {term: math.log((1 + len(counts)) / (1 + n)) + 1 for term, n in df.items()}
+    postings = {}
+    for i, tf in enumerate(counts):
+        vector = {term: (1 + math.log(w) if w > 1 else w) * idf[term] for term, w in tf.items()}
+        norm = math.sqrt(sum(v * v for v in vector.values())) or 1.0
+        for term, v in vector.items():
+            postings.setdefault(term, []).append((i, v / norm))
+    return {"answers": answers, "postings": postings, "idf": idf,
+            "unseen_idf": math.log(1 + len(counts)) + 1}
+
+def canned_match(index, query):
+    # Returns (entry, score) for the entry most similar to `query`.
+    tf = {}
+    for term in canned_terms(query):
+        tf[term] = tf.get(term, 0) + 1
+    # Words the corpus has never seen still count towards the query's length,
+    # so a question that only shares a word or two with an entry scores low.
+    vector = {term: (1 + math.log(n)) * index["idf"].get(term, index["unseen_idf"]) for term, n in tf.items()}
+    norm = math.sqrt(sum(v * v for v in vector.values()))
+    if not norm:
+        return None, 0.0
+    scores = {}
+    for term, v in vector.items():
+        for i, weight in index["postings"].get(term, ()):
+            scores[i] = scores.get(i, 0.0) + v * weight
+    if not scores:
+        return None, 0.0
+    best = max(scores, key=lambda i: (scores[i], -i))
+    return best, scores[best] / norm
+
+def canned_answer(query):
+    if not CANNED_ENABLED or answer_index is None:
+        return None
+    lookup_start = time.perf_counter()
+    best, score = canned_match(answer_index, query)
+    canned_stats["lookup_ms"] += (time.perf_counter() - lookup_start) * 1000.0
+    if score < CANNED_MIN_SCORE:
+        canned_stats["misses"] += 1
+        return None
+    canned_stats["hits"] += 1
+    return answer_index["answers"][best]
+
+def page_opening(key, path):
+    # Enough of the start of a page for page_excerpt(), read from the pack
+    # or the file without loading the rest of the page.
+    limit = 4 * CANNED_PAGE_CHARS
+    entry = content_pack["index"].get(key) if content_pack is not None else None
+    try:
+        if entry is not None:
+            offset, length = entry
+            text = content_pack["map"][offset:offset + min(length, limit)].decode("utf-8", "ignore")
+            complete = length <= limit
+        else:
+            with open(path, "r") as f:
+                text = f.read(limit)
+                complete = not f.read(1)
+    except OSError:
+        return ""
+    if not complete and len(" ".join(text.split())) <= CANNED_PAGE_CHARS:
+        # Mostly whitespace so far; the excerpt needs the whole page.
+        return load_page_text(*page_for_key(key))
+    return text
+
+def load_answer_index_step():
+    global answer_index
+    pages = preloaded_pages or {key: page_opening(key, path) for key, path in scan_pages().items()}
+    answer_index = build_answer_index(load_answer_entries(), pages)
+
+def canned_report():
+    lookups = canned_stats["hits"] + canned_stats["misses"]
+    return "Canned answers: {hits} hits, {misses} misses ({rate:.0f}% hit rate), {ms:.3f} ms per lookup".format(
+        rate=100.0 * canned_stats["hits"] / lookups if lookups else 0.0,
+        ms=canned_stats["lookup_ms"] / lookups if lookups else 0.0, **canned_stats)
+
+def check_canned(probes_path):
+    # Prints the score and answer of every probe question; fails if any of
+    # them gets a different canned answer than expected, or none.
+    with open(probes_path, "r") as f:
+        probes = json.load(f)["probes"]
+    load_answer_index_step()
+    failures = 0
+    for probe in probes:
+        best, score = canned_match(answer_index, probe["question"])
+        answer = answer_index["answers"][best] if best is not None and score >= CANNED_MIN_SCORE else None
+        expect = probe["expect"]
+        ok = answer is None if expect is None else answer is not None and answer.startswith(expect)
+        failures += not ok
+        print("%s %.2f  %-50s -> %s" % ("ok  " if ok else "FAIL", score, probe["question"],
+                                        answer[:40] if answer else "(model)"))
+    print("%d of %d probes as expected (CANNED_MIN_SCORE %.2f)" % (len(probes) - failures, len(probes), CANNED_MIN_SCORE))
+    return 1 if failures else 0
+
+def pregenerate_answers(questions_path, workers):
+    # Asks the model, `workers` questions at a time, every question that the
+    # corpus cannot answer yet, and adds the answers to ANSWERS_PATH.
+    with open(questions_path, "r") as f:
+        questions = list(dict.fromkeys(line.strip() for line in f if line.strip()))
+    entries = load_answer_entries()
+    load_answer_index_step()
+    missing = [question for question in questions if canned_answer(question) is None]
+    print("Before: " + canned_report())
+    print("Asking the model %d questions, %d at a time" % (len(missing), workers))
+
+    def ask(question):
+        ask_start = time.perf_counter()
+        request = {"cancel": threading.Event(), "resource": None, "backend": LLM_BACKEND}
+        answer = "".join(llm_generate_within_budget(build_messages(question, []), request)).strip()
+        if request.get("stopped") in ("tokens", "time"):
+            answer = trim_answer(answer)
+        return answer, time.perf_counter() - ask_start
+
+    failures = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = {pool.submit(ask, question): question for question in missing}
+        for future in concurrent.futures.as_completed(futures):
+            question = futures[future]
+            try:
+                answer, seconds = future.result()
+            except Exception as e:
+                failures += 1
+                print("  failed  %s: %s" % (question, e))
+                continue
+            if not answer:
+                failures += 1
+                print("  empty   %s" % question)
+                continue
+            entries.append({"question": question, "answer": answer, "source": OLLAMA_MODEL})
+            print("  %5.1f s  %s" % (seconds, question))
+    with open(ANSWERS_PATH + ".tmp", "w") as f:
+        json.dump({"answers": entries}, f, indent=1, ensure_ascii=False)
+    os.replace(ANSWERS_PATH + ".tmp", ANSWERS_PATH)
+    for key in canned_stats:
+        canned_stats[key] = 0
+    load_answer_index_step()
+    for question in questions:
+        canned_answer(question)
+    print("After:  " + canned_report())
+    return 1 if failures else 0
+
+# --- SPLASH SCREEN AND WARM-UP ---
+# The splash stays up while a background thread loads the fonts, renders the
+# fixed labels, reads every page into memory and builds the search index, and
+# a second thread asks Ollama to load the model so the first question does not
+# pay for a cold start. The splash ends once both are done, but never before
+# SPLASH_MIN_MS. Only the WARMUP_BLOCKING_STEPS, which the menu cannot be
+# drawn without, are always waited for; after SPLASH_MAX_MS the rest of
+# the warm-up and the model keep loading in the background. Benchmarks wait
+# for the whole warm-up so every run starts from the same state.
+SPLASH_MIN_MS = 0 if args.bench_scenario else 1000
+SPLASH_MAX_MS = 0 if args.bench_scenario else 8000
+WARMUP_BLOCKING_STEPS = ("fonts", "static_text", "chrome")   # Run first
+warmup_blocking_done = threading.Event()
+preloaded_pages = {}
+startup_stats = {"warmup_ms": {}, "warmup_errors": {}, "splash_ms": None, "model_warm": None,
+                 "time_to_interactive_ms": None, "first_question_ttft_ms": None}
+
+def warm_static_text():
+    for button in buttons:
+        render_text(get_font("main"), button["text"], True, WHITE)
+    for text in ("THE GUIDE", "SEARCH", "QUIT"):
+        render_text(get_font("main"), text, True, WHITE)
+    for text in ("INTRODUCTION", "THE GUIDE", "WHO", "WHAT", "WHY", "WHERE", "WHEN", "HOW"):
+        render_text(get_font("anim"), text, True, WHITE)
+    if args.memory_budget:
+        return
+    render_text(get_font("close"), "X", True, WHITE)
+    render_text(get_font("arrows"), "↑", True, WHITE)
+    render_text(get_font("arrows"), "↓", True, WHITE)
+    render_text(get_font("popup"), "> ", True, WHITE)
+    render_text(get_font("popup"), "SEARCH > ", True, WHITE)
+
+def preload_pages():
+    for key, page_path in scan_pages().items():
+        text = content_pack_text(content_pack, key) if content_pack is not None else None
+        if text is None:
+            try:
+                with open(page_path, "r") as f:
+                    text = f.read()
+            except OSError:
+                continue
+        preloaded_pages[key] = text
+
+def load_search_index_step():
+    global search_index
+    search_index = load_search_index()
+
+WARMUP_STEPS = [
+    ("fonts", lambda: load_fonts(MENU_FONTS if args.memory_budget else FONT_SPECS)),
+    ("static_text", warm_static_text),
+    ("chrome", lambda: chrome_for(screen.get_size())),
+    ("pages", preload_pages),
+    ("search_index", load_search_index_step),
+    ("answers", load_answer_index_step),
+]
+if args.memory_budget:
+    # Pages are read from the pack or the disk when they are opened instead.
+    WARMUP_STEPS = [step for step in WARMUP_STEPS if step[0] != "pages"]
+
+def run_warmup():
+    try:
+        for name, step in WARMUP_STEPS:
+            if name not in WARMUP_BLOCKING_STEPS:
+                warmup_blocking_done.set()
+            step_start = time.perf_counter()
+            try:
+                step()
+            except Exception as e:
+                # Whatever the step would have prepared is loaded on demand
+                # or left out; the other steps still run.
+                startup_stats["warmup_errors"][name] = "%s: %s" % (type(e).__name__, e)
+                print("Warm-up step %s failed: %s" % (name, startup_stats["warmup_errors"][name]))
+            startup_stats["warmup_ms"][name] = round((time.perf_counter() - step_start) * 1000.0, 1)
+    finally:
+        warmup_blocking_done.set()
+
+def warm_model():
+    # An empty prompt makes Ollama load the model without generating anything.
+    step_start = time.perf_counter()
+    try:
+        conn, response = ollama_request("/api/generate", {
+            "model": OLLAMA_MODEL,
+            "keep_alive": OLLAMA_KEEP_ALIVE,
+        })
+        response.read()
+        if response.status == 200:
+            ollama_release(conn)
+        else:
+            conn.close()
+        startup_stats["model_warm"] = response.status == 200
+    except Exception:
+        startup_stats["model_warm"] = False
+    startup_stats["warmup_ms"]["model"] = round((time.perf_counter() - step_start) * 1000.0, 1)
+
+def record_first_token(asked_at):
+    # Only answers from the model count: the point is to see the cold start.
+    if startup_stats["first_question_ttft_ms"] is None:
+        startup_stats["first_question_ttft_ms"] = round((time.perf_counter() - asked_at) * 1000.0, 1)
+
+def startup_report():
+    return "Startup: interactive after {tti} ms (splash {splash} ms, warm-up {steps}, model warm: {warm}), first answer token after {ttft} ms{errors}".format(
+        tti=startup_stats["time_to_interactive_ms"], splash=startup_stats["splash_ms"],
+        steps=", ".join("%s %.0f ms" % item for item in startup_stats["warmup_ms"].items()),
+        warm=startup_stats["model_warm"], ttft=startup_stats["first_question_ttft_ms"],
+        errors="".join("; %s failed (%s)" % item for item in startup_stats["warmup_errors"].items()))
+
+if args.pregenerate:
+    sys.exit(pregenerate_answers(args.pregenerate, args.pregenerate_workers))
+if args.check_canned:
+    sys.exit(check_canned(args.check_canned))
+
+splash_load_start = time.perf_counter()
+splash_img = load_image("assets/images/dont-panic.png", lambda size: (size[0] // 2, size[1] // 2))
+startup_stats["warmup_ms"]["splash_image"] = round((time.perf_counter() - splash_load_start) * 1000.0, 1)
+splash_rect = splash_img.get_rect(center=(WIDTH // 2, HEIGHT // 2))
+splash_start = pygame.time.get_ticks()
+
+warmup_thread = threading.Thread(target=run_warmup, daemon=True)
+warmup_thread.start()
+model_thread = None
+if LLM_BACKEND == "http":
+    model_thread = threading.Thread(target=warm_model, daemon=True)
+    model_thread.start()
+
+while True:
+    splash_elapsed = pygame.time.get_ticks() - splash_start
+    warm = not warmup_thread.is_alive() and (model_thread is None or not model_thread.is_alive())
+    ready = warmup_blocking_done.is_set() and not (args.bench_scenario and warmup_thread.is_alive())
+    if splash_elapsed >= SPLASH_MIN_MS and ready and (warm or splash_elapsed >= SPLASH_MAX_MS):
+        break
+    for event in pygame.event.get():
+        if event.type == pygame.QUIT:
+            pygame.quit()
+            sys.exit()
+    screen.fill(SALMON)
+    screen.blit(splash_img, splash_rect)
+    pygame.display.flip()
+    clock.tick(60)
+startup_stats["splash_ms"] = pygame.time.get_ticks() - splash_start
+# The splash is never shown again.
+del splash_img
+# --- END SPLASH SCREEN ---
+
+if args.bench_scenario:
+    bench_scenario = load_scenario(args.bench_scenario)
+    if not bench_scenario.get("intro", False):
+        main_list_elapsed = len(buttons) * MAIN_BUTTON_WIDTH / BUTTON_GROWTH_SPEED
+    threading.Thread(target=replay_scenario, args=(bench_scenario["steps"],), daemon=True).start()
+
+mark_dirty()
 running = True
 while running:
+    profile_start_frame()
+    # --- FRAME PACING ---
+    if pacing_state == "idle":
+        event = pygame.event.wait(IDLE_WAIT_MS)
+        events = [event] if event.type != pygame.NOEVENT else []
+        events += pygame.event.get()
+        frame_dt = min(clock.tick() / 1000.0, MAX_FRAME_DT)
+    else:
+        frame_dt = min(clock.tick(ACTIVE_FPS) / 1000.0, MAX_FRAME_DT)
+        events = pygame.event.get()
+    if events:
+        last_input_ticks = pygame.time.get_ticks()
+    profile_phase("wait")
+    frame_work_start = time.perf_counter()
+    if recorded_steps is not None:
+        for event in events:
+            record_event(event)
+
     # --- MAIN LIST BUTTON ANIMATION ---
     if not main_list_animation_done:
-        if current_button_index < len(buttons):
-            btn = buttons[current_button_index]
-            if btn["rect"].width < MAIN_BUTTON_WIDTH:
-                btn["rect"].width += BUTTON_GROWTH_SPEED
-            else:
-                btn["rect"].width = MAIN_BUTTON_WIDTH
-                current_button_index += 1
-        else:
-            main_list_animation_done = True
-
-    click_pos = None
-    handled_main_click = False
+        main_list_elapsed += frame_dt
+        grow_time = MAIN_BUTTON_WIDTH / BUTTON_GROWTH_SPEED
+        for i, btn in enumerate(buttons):
+            width = int(min(max(main_list_elapsed - i * grow_time, 0) * BUTTON_GROWTH_SPEED, MAIN_BUTTON_WIDTH))
+            if width != btn["rect"].width:
+                mark_dirty(btn["rect"])
+                btn["rect"].width = width
+                mark_dirty(btn["rect"])
+        main_list_animation_done = main_list_elapsed >= len(buttons) * grow_time
+    profile_phase("animation")
 
     # --- EVENT HANDLING ---
-    for event in pygame.event.get():
+    for event in events:
         if event.type == pygame.QUIT:
             running = False
 
+        elif event.type == pygame.KEYDOWN and event.key == pygame.K_F3:
+            profile_hud = not profile_hud
+            profile_hud_drawn_ticks = -PROFILE_HUD_REFRESH_MS
+            mark_dirty(PROFILE_HUD_RECT)
+
+        elif event.type == pygame.KEYDOWN and event.key == pygame.K_F4:
+            profile_dump(args.profile_out)
+
+        elif event.type == pygame.KEYDOWN and event.key == pygame.K_F5:
+            memory_sample(ui_mode())
+            memory_dump(args.memory_out)
+
         elif event.type == pygame.KEYDOWN:
+            if popup_active and search_mode:
+                mark_dirty(popup_bounds())
+                if event.key == pygame.K_RETURN:
+                    if search_results:
+                        category, label = page_for_key(search_results[0]["key"])
+                        popup_text = load_page_text(category, label)
+                        page_layout = open_page_layout(popup_text)
+                        search_mode = False
+                        popup_scroll_offset = 0
+                        mark_dirty()
+                else:
+                    if event.key == pygame.K_BACKSPACE:
+                        search_query = search_query[:-1]
+                    else:
+                        search_query += event.unicode
+                    search_results = run_search(search_query, SEARCH_RESULT_WIDTH)
+                    search_results_index = search_index
             if popup_active and guide_mode:
+                mark_dirty(input_box_bounds())
                 if event.key == pygame.K_RETURN:
                     if llm_input_text.strip() != "":
-                        prompt = build_prompt(llm_input_text)
+                        mark_dirty(popup_bounds())
                         llm_conversation.append("You: " + llm_input_text)
                         llm_conversation.append("Guide: ")
-                        response_index = len(llm_conversation) - 1
-                        t = threading.Thread(target=llm_thread_stream, args=(prompt, response_index))
-                        t.daemon = True
-                        t.start()
-                        llm_threads.append(t)
+                        spill_conversation()
+                        response_index = llm_conversation_base + len(llm_conversation) - 1
+                        # Canned answers follow LLM_BUSY_POLICY too: "replace" stops the answer
+                        # in progress, otherwise they are only used while the model is idle.
+                        canned = None
+                        if not chat_history_for(llm_session) and (LLM_BUSY_POLICY == "replace" or not llm_busy()):
+                            canned = canned_answer(llm_input_text)
+                        if canned is not None:
+                            if LLM_BUSY_POLICY == "replace":
+                                llm_skip_all()
+                            llm_conversation[-1] = "Guide: " + canned
+                            chat_add_turn(llm_session, llm_input_text, canned)
+                        elif not llm_submit(llm_input_text, response_index, llm_session):
+                            llm_conversation[-1] = "Guide: Still working on your last question. Ask again in a moment."
                         llm_input_text = ""
                 elif event.key == pygame.K_BACKSPACE:
                     llm_input_text = llm_input_text[:-1]
@@ -265,59 +2564,110 @@ while running:
             if popup_active and guide_mode:
                 SCROLL_FACTOR = 300
                 guide_scroll_offset -= event.dy * SCROLL_FACTOR
+                mark_dirty(popup_bounds())
 
         elif event.type == pygame.MOUSEBUTTONDOWN:
-            if QUIT_BUTTON_RECT.collidepoint(event.pos):
+            target = hit_test(event.pos)
+            action = target["action"] if target else None
+            if action == "quit":
                 running = False
                 break
 
-            if popup_active:
-                popup_rect = pygame.Rect((WIDTH - popup_width) // 2, (HEIGHT - popup_height) // 2, popup_width, popup_height)
-                close_button_rect = pygame.Rect(popup_rect.right - 40, popup_rect.top + 10, 30, 30)
-                if event.button == 1 and close_button_rect.collidepoint(event.pos):
-                    llm_threads.clear()
-                    llm_conversation = []
-                    llm_input_text = ""
-                    popup_active = False
-                    guide_mode = False
-                    active_button = None
+            if action == "close" and event.button == 1:
+                llm_cancel_all()
+                chat_reset()
+                llm_conversation = []
+                llm_session += 1
+                llm_conversation_base = 0
+                llm_input_text = ""
+                popup_active = False
+                guide_mode = False
+                search_mode = False
+                search_query = ""
+                search_results = []
+                active_button = None
+                animate_expansion = False
+                retract_animation = False
+                intro_bar_width = 0
+                stack_bars_width = 0
+                show_text = False
+                popup_text = ""
+                page_layout = None
+                popup_scroll_offset = 0
+                guide_scroll_offset = 0
+                mark_dirty()
+                gc.collect()
+
+            elif action == "result" and event.button == 1:
+                # Open the page through the same path as the label stacks.
+                category, label = page_for_key(target["result"]["key"])
+                popup_text = load_page_text(category, label)
+                page_layout = open_page_layout(popup_text)
+                search_mode = False
+                popup_scroll_offset = 0
+                mark_dirty()
+
+            elif action == "scroll_up" and event.button == 1:
+                guide_scroll_offset = max(guide_scroll_offset - 50, 0)
+                mark_dirty(popup_bounds())
+
+            elif action == "scroll_down" and event.button == 1:
+                guide_scroll_offset += 50
+                mark_dirty(popup_bounds())
+
+            elif action == "main_button":
+                button = target["button"]
+                if active_button is not None:
+                    mark_dirty(expansion_bounds(active_button))
+                mark_dirty(expansion_bounds(button))
+                if active_button is not None and active_button == button and animate_expansion:
+                    intro_bar_width = INTRO_BAR_MAX_WIDTH
+                    stack_bars_width = STACK_BARS_MAX_WIDTH
+                    show_text = True
                     animate_expansion = False
+                else:
+                    active_button = button
+                    animate_expansion = True
                     retract_animation = False
                     intro_bar_width = 0
                     stack_bars_width = 0
                     show_text = False
-                    popup_scroll_offset = 0
-                    guide_scroll_offset = 0
-                    gc.collect()
 
-            if popup_active and guide_mode:
-                margin = 20
-                input_box_height = 40
-                popup_rect = pygame.Rect((WIDTH - popup_width) // 2, (HEIGHT - popup_height) // 2, popup_width, popup_height)
-                conversation_area_rect = pygame.Rect(
-                    popup_rect.left + margin,
-                    popup_rect.top + margin,
-                    popup_rect.width - 2 * margin - (SCROLLBAR_WIDTH + SCROLL_BTN_WIDTH + 10),
-                    popup_rect.height - 2 * margin - input_box_height - 10
-                )
-                # Place arrow buttons immediately to the right of the scrollbar.
-                up_button_rect = pygame.Rect(
-                    conversation_area_rect.right + 5,
-                    conversation_area_rect.top + 60,  # Moved down by 60 pixels so it doesn't cover the X button
-                    SCROLL_BTN_WIDTH, SCROLL_BTN_HEIGHT
-                )
-                down_button_rect = pygame.Rect(
-                    conversation_area_rect.right + 5,
-                    conversation_area_rect.bottom - SCROLL_BTN_HEIGHT,
-                    SCROLL_BTN_WIDTH, SCROLL_BTN_HEIGHT
-                )
-                if event.button == 1:
-                    if up_button_rect.collidepoint(event.pos):
-                        guide_scroll_offset = max(guide_scroll_offset - 50, 0)
-                    elif down_button_rect.collidepoint(event.pos):
-                        guide_scroll_offset += 50
+            elif action == "guide":
+                popup_active = True
+                guide_mode = True
+                llm_input_text = ""
+                llm_conversation = []
+                llm_session += 1
+                llm_conversation_base = 0
+                guide_scroll_offset = 0
+                mark_dirty()
+
+            elif action == "search":
+                popup_active = True
+                guide_mode = False
+                search_mode = True
+                search_query = ""
+                search_results = []
+                mark_dirty()
+
+            elif action == "label" and active_button and intro_bar_width >= INTRO_BAR_MAX_WIDTH and show_text:
+                popup_text = load_page_text(active_button["text"], target["label"])
+                page_layout = open_page_layout(popup_text)
+                popup_active = True
+                guide_mode = False
+                active_button = None
+                animate_expansion = False
+                retract_animation = False
+                intro_bar_width = 0
+                stack_bars_width = 0
+                show_text = False
+                popup_scroll_offset = 0
+                mark_dirty()
 
             if popup_active:
+                if event.button in (4, 5):
+                    mark_dirty(popup_bounds())
                 if guide_mode:
                     if event.button == 4:
                         guide_scroll_offset -= 20
@@ -329,246 +2679,166 @@ while running:
                     elif event.button == 5:
                         popup_scroll_offset += 20
 
-            if not popup_active:
-                for button in buttons:
-                    if button["rect"].collidepoint(event.pos):
-                        if active_button is not None and active_button == button and animate_expansion:
-                            intro_bar_width = INTRO_BAR_MAX_WIDTH
-                            stack_bars_width = STACK_BARS_MAX_WIDTH
-                            show_text = True
-                            animate_expansion = False
-                        else:
-                            active_button = button
-                            animate_expansion = True
-                            retract_animation = False
-                            intro_bar_width = 0
-                            stack_bars_width = 0
-                            show_text = False
-                        handled_main_click = True
-                        break
-                if not handled_main_click:
-                    guide_button_width = MAIN_BUTTON_WIDTH - 250
-                    guide_button_height = button_height
-                    guide_button_x = MAIN_BUTTON_X
-                    guide_button_y = HEIGHT - (bottom_margin / 1.75) - guide_button_height
-                    guide_button_rect = pygame.Rect(guide_button_x, guide_button_y, guide_button_width, guide_button_height)
-                    if guide_button_rect.collidepoint(event.pos):
-                        popup_active = True
-                        guide_mode = True
-                        llm_input_text = ""
-                        llm_conversation = []
-                        guide_scroll_offset = 0
-                        handled_main_click = True
-                    else:
-                        click_pos = event.pos
+    profile_phase("events")
 
-    if popup_active:
-        for button in buttons:
-            if button["rect"].x > -600:
-                button["rect"].x -= SLIDE_SPEED
-    else:
-        for button in buttons:
-            if button["rect"].x < MAIN_BUTTON_X:
-                button["rect"].x += SLIDE_SPEED
-                if button["rect"].x > MAIN_BUTTON_X:
-                    button["rect"].x = MAIN_BUTTON_X
+    # Pick up everything the LLM threads produced since the last frame.
+    if llm_stream_drain():
+        mark_dirty(popup_bounds())
+    if search_mode and search_results_index is not search_index:
+        # The index was finished after the splash; search again for what was typed.
+        search_results = run_search(search_query, SEARCH_RESULT_WIDTH)
+        search_results_index = search_index
+        mark_dirty(popup_bounds())
+    profile_phase("stream")
 
-    screen.fill((250, 240, 120))
-
-    for button in buttons:
-        draw_button(screen, button)
+    slide_target = SLIDE_DISTANCE if popup_active else 0
+    if slide_offset != slide_target:
+        slide_offset = step_towards(slide_offset, slide_target, SLIDE_SPEED * frame_dt)
+        for button in buttons:
+            mark_dirty(button["rect"])
+            button["rect"].x = MAIN_BUTTON_X - int(slide_offset)
+            mark_dirty(button["rect"])
 
-    vertical_label_rects = []
+    # --- EXPANSION ANIMATION ---
     if active_button and not popup_active:
-        active_button_rect = active_button["rect"]
+        expansion_region = expansion_bounds(active_button)
+        expansion_before = (intro_bar_width, stack_bars_width, show_text)
         if retract_animation:
             show_text = False
             if stack_bars_width > 0:
-                stack_bars_width -= BAR_RETRACT_SPEED
+                stack_bars_width = max(stack_bars_width - BAR_RETRACT_SPEED * frame_dt, 0)
             elif intro_bar_width > 0:
-                intro_bar_width -= RETRACT_SPEED
+                intro_bar_width = max(intro_bar_width - RETRACT_SPEED * frame_dt, 0)
             else:
                 animate_expansion = False
                 active_button = None
         else:
             if animate_expansion:
                 if intro_bar_width < INTRO_BAR_MAX_WIDTH:
-                    intro_bar_width += BAR_GROWTH_SPEED
+                    intro_bar_width = min(intro_bar_width + BAR_GROWTH_SPEED * frame_dt, INTRO_BAR_MAX_WIDTH)
                 elif stack_bars_width < STACK_BARS_MAX_WIDTH:
-                    stack_bars_width += BAR_GROWTH_SPEED
+                    stack_bars_width = min(stack_bars_width + BAR_GROWTH_SPEED * frame_dt, STACK_BARS_MAX_WIDTH)
                     show_text = True
+        if active_button is None or (intro_bar_width, stack_bars_width, show_text) != expansion_before:
+            mark_dirty(expansion_region)
+    profile_phase("animation")
 
+    # The overlay is redrawn a couple of times a second rather than every
+    # frame so that showing it does not keep the loop out of idle.
+    if profile_hud and pygame.time.get_ticks() - profile_hud_drawn_ticks >= PROFILE_HUD_REFRESH_MS:
+        profile_hud_drawn_ticks = pygame.time.get_ticks()
+        mark_dirty(PROFILE_HUD_RECT)
+
+    # --- FRAME CLIP ---
+    # Drawing below is clipped to the damaged area; with nothing damaged the
+    # clip is empty and the frame draws nothing.
+    if DIRTY_RECTS:
+        frame_rects = dirty_rects[:]
+        del dirty_rects[:]
+        if frame_rects:
+            frame_clip = frame_rects[0].unionall(frame_rects[1:]).clip(screen.get_rect())
+        else:
+            frame_clip = pygame.Rect(0, 0, 0, 0)
+    else:
+        frame_clip = screen.get_rect()
+    screen.set_clip(frame_clip)
+
+    chrome = chrome_for(screen.get_size())
+    screen.blit(chrome["background"], (0, 0))
+
+    for button in buttons:
+        draw_button(screen, button)
+
+    if active_button and not popup_active:
+        ui_sync()
+        active_button_rect = active_button["rect"]
         intro_rect = pygame.Rect(
             active_button_rect.right,
             active_button_rect.y,
-            intro_bar_width,
+            int(intro_bar_width),
             active_button_rect.height
         )
-        pygame.draw.rect(screen, GREEN, intro_rect, border_radius=15)
+        blit_bar(screen, GREEN, intro_rect)
         if show_text:
-            intro_text_surf = font_anim.render("INTRODUCTION", True, WHITE)
+            intro_text_surf = render_text(get_font("anim"), "INTRODUCTION", True, WHITE)
             intro_text_rect = intro_text_surf.get_rect(midright=(intro_rect.right - 10, intro_rect.centery))
             screen.blit(intro_text_surf, intro_text_rect)
 
         if intro_bar_width >= INTRO_BAR_MAX_WIDTH and show_text:
-            if active_button["text"] == "HITCHHIKING":
-                labels = ["THE GUIDE"]
-            else:
-                labels = ["WHO", "WHAT", "WHY", "WHERE", "WHEN", "HOW"]
-            bar_height = active_button_rect.height
-            total_stack_height = len(labels) * bar_height
-            bottom_anchor_y = intro_rect.top
-            for i, label in enumerate(labels):
-                topY = bottom_anchor_y - total_stack_height + i * bar_height
-                bar_rect = pygame.Rect(
-                    intro_rect.right - min(stack_bars_width, STACK_BARS_MAX_WIDTH),
-                    topY,
-                    min(stack_bars_width, STACK_BARS_MAX_WIDTH),
-                    bar_height
-                )
-                pygame.draw.rect(screen, list_colors[i], bar_rect, border_radius=15)
-                label_surf = font_anim.render(label, True, WHITE)
-                label_rect = label_surf.get_rect(midright=(bar_rect.right - 10, bar_rect.centery))
-                screen.blit(label_surf, label_rect)
-                vertical_label_rects.append((label_rect, label))
-
-    if not popup_active and click_pos is not None and vertical_label_rects and active_button:
-        for rect, label in vertical_label_rects:
-            if rect.collidepoint(click_pos):
-                popup_text = load_page_text(active_button["text"], label)
-                popup_active = True
-                guide_mode = False
-                active_button = None
-                animate_expansion = False
-                retract_animation = False
-                intro_bar_width = 0
-                stack_bars_width = 0
-                show_text = False
-                popup_scroll_offset = 0
-                break
+            bar_width = int(min(stack_bars_width, STACK_BARS_MAX_WIDTH))
+            for label_widget in ui["label_stack"]["children"]:
+                slot = label_widget["slot"]
+                blit_bar(screen, label_widget["color"], (slot.right - bar_width, slot.y, bar_width, slot.height))
+                screen.blit(render_text(get_font("anim"), label_widget["label"], True, WHITE), label_widget["rect"])
 
-    purple_bar_height = 48
-    purple_bar_rect = pygame.Rect(0, HEIGHT - purple_bar_height, WIDTH, purple_bar_height)
-    pygame.draw.rect(screen, PURPLE, purple_bar_rect)
-
-    guide_button_width = MAIN_BUTTON_WIDTH - 250
-    guide_button_height = button_height
-    guide_button_x = MAIN_BUTTON_X
-    guide_button_y = HEIGHT - (bottom_margin / 1.75) - guide_button_height
-    guide_button_rect = pygame.Rect(guide_button_x, guide_button_y, guide_button_width, guide_button_height)
-    pygame.draw.rect(screen, list_colors[5], guide_button_rect, border_radius=15)
-    guide_text_surf = font_main.render("THE GUIDE", True, WHITE)
-    guide_text_rect = guide_text_surf.get_rect(midright=(guide_button_rect.right - 10, guide_button_rect.centery))
-    screen.blit(guide_text_surf, guide_text_rect)
+    profile_phase("draw_main")
 
     # --- POPUP WINDOW DRAWING ---
     if popup_active:
-        popup_rect = pygame.Rect((WIDTH - popup_width) // 2, (HEIGHT - popup_height) // 2, popup_width, popup_height)
-        popup_border_thickness = 12
-        outer_rect = popup_rect.inflate(popup_border_thickness, popup_border_thickness)
-        pygame.draw.rect(screen, (80, 80, 80), outer_rect, border_radius=15)
-        pygame.draw.rect(screen, (200, 200, 200), outer_rect, 2, border_radius=15)
-        pygame.draw.rect(screen, BLACK, popup_rect, border_radius=10)
-
-        # Draw close button ("X") in the upper right corner.
-        close_button_rect = pygame.Rect(popup_rect.right - 40, popup_rect.top + 10, 30, 30)
-        pygame.draw.rect(screen, GREY, close_button_rect)
-        x_text = font_close.render("X", True, WHITE)
-        x_text_rect = x_text.get_rect(center=close_button_rect.center)
-        screen.blit(x_text, x_text_rect)
-
-        if guide_mode:
-            margin = 20
-            input_box_height = 40
-            # Define conversation area with room for a narrow scrollbar and arrow buttons.
-            conversation_area_rect = pygame.Rect(
-                popup_rect.left + margin,
-                popup_rect.top + margin,
-                popup_rect.width - 2 * margin - (SCROLLBAR_WIDTH + SCROLL_BTN_WIDTH + 10),
-                popup_rect.height - 2 * margin - input_box_height - 10
-            )
-            input_box_rect = pygame.Rect(
-                popup_rect.left + margin,
-                popup_rect.bottom - margin - input_box_height,
-                popup_rect.width - 2 * margin,
-                input_box_height
-            )
+        ui_sync()
+        popup_rect = ui["popup"]["rect"]
+        input_box_rect = ui["input_box"]["rect"]
+        # Frame, black body and the close button ("X") in one blit.
+        screen.blit(popup_frame_for(chrome), chrome["popup_pos"])
+
+        if search_mode:
+            for row in ui["search_results"]["children"]:
+                row_rect = row["rect"]
+                screen.blit(render_text(get_font("popup"), row["result"]["title"], True, BABY_BLUE), (row_rect.left, row_rect.top))
+                screen.blit(render_text(get_font("popup"), row["result"]["snippet"], True, GREY),
+                            (row_rect.left, row_rect.top + get_font("popup").get_height() + 5))
+            if search_query.strip() and not search_results:
+                message = "Reading the pages..." if search_index is None else "Nothing found. Don't panic."
+                screen.blit(render_text(get_font("popup"), message, True, GREY), ui["search_results"]["rect"].topleft)
+            pygame.draw.rect(screen, WHITE, input_box_rect, 2)
+            input_text_surf = render_text(get_font("popup"), "SEARCH > " + search_query, True, WHITE)
+            screen.blit(input_text_surf, (input_box_rect.left + 5, input_box_rect.centery - input_text_surf.get_height() / 2))
+        elif guide_mode:
+            conversation_area_rect = ui["conversation"]["rect"]
             # Draw conversation area with scrolling.
-            screen.set_clip(conversation_area_rect)
-            y_offset = conversation_area_rect.top - guide_scroll_offset
-            total_conv_height = 0
-            conv_lines = []
-            for line in llm_conversation:
-                wrapped = wrap_text(line, font_popup, conversation_area_rect.width)
-                for wline in wrapped:
-                    conv_lines.append(wline)
-                    total_conv_height += font_popup.get_height() + 5
-            for wline in conv_lines:
-                text_surface = font_popup.render(wline, True, BABY_BLUE)
-                screen.blit(text_surface, (conversation_area_rect.left, y_offset))
-                y_offset += text_surface.get_height() + 5
-            screen.set_clip(None)
+            screen.set_clip(conversation_area_rect.clip(frame_clip))
+            total_conv_height = update_conversation_layout(get_font("popup"), conversation_area_rect.width)
+            draw_conversation(screen, get_font("popup"), conversation_area_rect, guide_scroll_offset)
+            screen.set_clip(frame_clip)
             max_guide_offset = max(0, total_conv_height - conversation_area_rect.height)
             # Auto scroll down.
             guide_scroll_offset = max_guide_offset
             # Draw narrow scrollbar to the right of conversation area.
-            track_x = conversation_area_rect.right
-            track_y = conversation_area_rect.top
-            track_height = conversation_area_rect.height
-            pygame.draw.rect(screen, GREY, (track_x, track_y, SCROLLBAR_WIDTH, track_height))
+            track_x, track_y, _, track_height = ui["guide_track"]["rect"]
+            pygame.draw.rect(screen, GREY, ui["guide_track"]["rect"])
             if total_conv_height > conversation_area_rect.height:
                 thumb_height = (conversation_area_rect.height / total_conv_height) * track_height
                 thumb_y = track_y + (guide_scroll_offset / max_guide_offset) * (track_height - thumb_height) if max_guide_offset > 0 else track_y
                 pygame.draw.rect(screen, (200, 200, 200), (track_x, thumb_y, SCROLLBAR_WIDTH, thumb_height))
             # Draw scroll arrow buttons immediately to the right of the scrollbar.
-            up_button_rect = pygame.Rect(
-                track_x + SCROLLBAR_WIDTH + 5,
-                conversation_area_rect.top + 60,
-                SCROLL_BTN_WIDTH, SCROLL_BTN_HEIGHT
-            )
-            down_button_rect = pygame.Rect(
-                track_x + SCROLLBAR_WIDTH + 5,
-                conversation_area_rect.bottom - SCROLL_BTN_HEIGHT,
-                SCROLL_BTN_WIDTH, SCROLL_BTN_HEIGHT
-            )
+            up_button_rect = ui["scroll_up"]["rect"]
+            down_button_rect = ui["scroll_down"]["rect"]
             pygame.draw.rect(screen, GREY, up_button_rect, border_radius=5)
             pygame.draw.rect(screen, GREY, down_button_rect, border_radius=5)
-            up_text = font_arrows.render("↑", True, WHITE)
-            down_text = font_arrows.render("↓", True, WHITE)
+            up_text = render_text(get_font("arrows"), "↑", True, WHITE)
+            down_text = render_text(get_font("arrows"), "↓", True, WHITE)
             up_text_rect = up_text.get_rect(center=up_button_rect.center)
             down_text_rect = down_text.get_rect(center=down_button_rect.center)
             screen.blit(up_text, up_text_rect)
             screen.blit(down_text, down_text_rect)
             # Draw input box.
             pygame.draw.rect(screen, WHITE, input_box_rect, 2)
-            input_text_surf = font_popup.render("> " + llm_input_text, True, WHITE)
+            input_text_surf = render_text(get_font("popup"), "> " + llm_input_text, True, WHITE)
             screen.blit(input_text_surf, (input_box_rect.left + 5, input_box_rect.centery - input_text_surf.get_height() / 2))
         else:
-            scrollbar_width = 10
-            text_clip_rect = pygame.Rect(popup_rect.left, popup_rect.top, popup_rect.width - (scrollbar_width + 5), popup_rect.height)
-            screen.set_clip(text_clip_rect)
-            margin = 20
-            track_top_offset = 30
-            effective_width = popup_rect.width - 2 * margin - (scrollbar_width + 5)
-            lines_raw = popup_text.splitlines()
-            wrapped_lines = []
-            for line in lines_raw:
-                wrapped_lines.extend(wrap_text(line, font_popup, effective_width))
-            line_height = font_popup.get_height() + 5
-            visible_area = popup_rect.height - 2 * margin - track_top_offset
-            total_text_height = line_height * len(wrapped_lines)
+            text_clip_rect = ui["page_text"]["rect"]
+            screen.set_clip(text_clip_rect.clip(frame_clip))
+            if page_layout is None:
+                page_layout = open_page_layout(popup_text)
+            track_x, track_y, scrollbar_width, track_height = ui["page_track"]["rect"]
+            visible_area = track_height
+            total_text_height = page_layout["height"]
             max_scroll_offset = max(total_text_height - visible_area, 0)
             popup_scroll_offset = max(0, min(popup_scroll_offset, max_scroll_offset))
-            y_offset = popup_rect.top + margin + track_top_offset - popup_scroll_offset
-            for line in wrapped_lines:
-                text_surface = font_popup.render(line, True, BABY_BLUE)
-                screen.blit(text_surface, (popup_rect.left + margin, y_offset))
-                y_offset += text_surface.get_height() + 5
-            screen.set_clip(None)
-            track_x = popup_rect.right - scrollbar_width - 5
-            track_y = popup_rect.top + margin + track_top_offset
-            track_height = visible_area
-            pygame.draw.rect(screen, GREY, (track_x, track_y, scrollbar_width, track_height))
+            y_offset = track_y - popup_scroll_offset
+            blit_page(screen, page_layout, popup_rect.left + PAGE_MARGIN, y_offset, text_clip_rect)
+            screen.set_clip(frame_clip)
+            pygame.draw.rect(screen, GREY, ui["page_track"]["rect"])
             if total_text_height > visible_area:
                 thumb_height = (visible_area / total_text_height) * track_height
                 thumb_y = track_y + (popup_scroll_offset / max_scroll_offset) * (track_height - thumb_height) if max_scroll_offset > 0 else track_y
@@ -578,14 +2848,58 @@ while running:
             THUMB_COLOR = (200, 200, 200)
             pygame.draw.rect(screen, THUMB_COLOR, (track_x, thumb_y, scrollbar_width, thumb_height))
 
-    pygame.draw.rect(screen, GREY, QUIT_BUTTON_RECT, border_radius=5)
-    pygame.draw.rect(screen, WHITE, QUIT_BUTTON_RECT, 2, border_radius=5)
-    quit_text = font_main.render("QUIT", True, WHITE)
-    quit_text_rect = quit_text.get_rect(center=QUIT_BUTTON_RECT.center)
-    screen.blit(quit_text, quit_text_rect)
+    profile_phase("popup")
 
-    pygame.display.flip()
-    clock.tick(30)
+    screen.blit(chrome["quit"], QUIT_BUTTON_RECT.topleft)
+    profile_phase("draw_main")
 
-pygame.quit()
+    if profile_hud and frame_clip.colliderect(PROFILE_HUD_RECT):
+        draw_profile_hud(screen)
+    profile_phase("hud")
+
+    screen.set_clip(None)
+    if not DIRTY_RECTS:
+        pygame.display.flip()
+    elif frame_rects:
+        pygame.display.update(frame_rects)
+    if bench_frame_times is not None and (not DIRTY_RECTS or frame_rects):
+        bench_frame_times.append((time.perf_counter() - frame_work_start) * 1000.0)
+    profile_phase("present")
+    profile_end_frame()
+    if startup_stats["time_to_interactive_ms"] is None:
+        startup_stats["time_to_interactive_ms"] = round((time.perf_counter() - process_start) * 1000.0, 1)
 
+    # Decide how the next frame is paced.
+    animating = (
+        not main_list_animation_done
+        or slide_offset != (SLIDE_DISTANCE if popup_active else 0)
+        or retract_animation
+        or (animate_expansion and (intro_bar_width < INTRO_BAR_MAX_WIDTH or stack_bars_width < STACK_BARS_MAX_WIDTH))
+        or llm_busy()
+        or llm_stream_waiting()   # A last piece pushed after this frame's drain
+        or (search_mode and warmup_thread.is_alive())
+        or dirty_rects
+        or pygame.time.get_ticks() - last_input_ticks < IDLE_GRACE_MS
+    )
+    if pacing_state == "active" and not animating:
+        memory_sample(ui_mode())
+    pacing_state = "active" if animating else "idle"
+
+print(text_cache_report())
+print(asset_cache_report())
+print(llm_cache_report())
+print(canned_report())
+print(llm_metrics_report())
+print(startup_report())
+memory_sample(ui_mode())
+print(memory_report())
+if not args.bench_scenario:
+    # Benchmark runs would overwrite the reports from real use.
+    profile_dump(args.profile_out)
+    memory_dump(args.memory_out)
+if args.bench_out:
+    with open(args.bench_out, "w") as f:
+        json.dump({"frame_ms": bench_frame_times, "llm": llm_metrics_summary()}, f)
+if args.record_events:
+    save_recording(args.record_events)
+pygame.quit()